@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# Measures the throughput, latency, parse time and memory of pycast against
+# the local mock server, and compares the report with an older one:
+#
+#   python benchmarks/bench.py --output 0.0.2.json
+#   python benchmarks/bench.py --compare 0.0.2.json
+#
+# Every scenario runs in a forked process, so their peak memory doesn't
+# add up. The exit status is 1 if the comparison finds regressions.
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import pycast
+
+import fixtures
+from mockserver import MockServer
+
+
+FIRST_DAY = datetime.date(2012, 3, 31)
+
+
+def _day(index):
+    # Every call asks for another day, so none are coalesced.
+    return FIRST_DAY - datetime.timedelta(days=index % 3650)
+
+
+REQUESTS = [
+    ('artist.get_top_tracks', lambda session, i: session.artist(
+        'Madonna').get_top_tracks(pycast.DAY, _day(i), cache=False)),
+    ('artist.get_top_tracks.columnar', lambda session, i: session.artist(
+        'Madonna').get_top_tracks(pycast.DAY, _day(i), cache=False,
+                                  columnar=True)),
+    ('artist.get_top_channels', lambda session, i: session.artist(
+        'Madonna').get_top_channels(pycast.DAY, _day(i), cache=False)),
+    ('channel.get_top_artists', lambda session, i: session.channel(
+        fixtures.CHANNELS[0]).get_top_artists(pycast.DAY, _day(i),
+                                              cache=False)),
+    ('label.get_top_tracks', lambda session, i: session.label(
+        'BCore').get_top_tracks(pycast.DAY, _day(i), cache=False)),
+    ('chart.get_top_tracks', lambda session, i: pycast.Chart(
+        pycast.DAY, _day(i), session).get_top_tracks(cache=False)),
+    ('artist.get_matches', lambda session, i: session.artist(
+        'Madonna').get_matches(pycast.DAY, _day(i), cache=False)),
+    ('match.get_duration', lambda session, i: pycast.Match(
+        str(i), session).get_duration()),
+]
+
+PARSES = [
+    ('parse.top_tracks', fixtures.top_tracks, 'track', '_top_track'),
+    ('parse.top_artists', fixtures.top_artists, 'artist', '_top_artist'),
+    ('parse.top_channels', fixtures.top_channels, 'channel', '_top_channel'),
+]
+
+
+def _percentile(values, percent):
+    """Returns the nearest-rank percentile of sorted values."""
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def _max_rss():
+    """Returns the peak resident memory of the process, in KB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def _run_requests(call, requests, concurrency):
+    session = pycast.Session('bench', 'bench')
+    pycast.configure_connection_pool(size=max(concurrency, 10))
+    for i in xrange(min(requests, 10)):
+        call(session, requests + i)
+
+    def timed(i):
+        start = time.time()
+        call(session, i)
+        return time.time() - start
+
+    start = time.time()
+    if concurrency == 1:
+        latencies = map(timed, xrange(requests))
+    else:
+        pool = ThreadPool(concurrency)
+        try:
+            latencies = pool.map(timed, xrange(requests), 1)
+        finally:
+            pool.close()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {'requests': requests,
+            'concurrency': concurrency,
+            'rps': requests / elapsed,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p90_ms': _percentile(latencies, 90) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000}
+
+
+def _run_parse(render, tag, build, items, repeat):
+    session = pycast.Session('bench', 'bench')
+    entity = session.artist('Madonna')
+    body = render(items)
+    build = getattr(entity, build)
+    start = time.time()
+    for i in xrange(repeat):
+        map(build, pycast._iterparse(StringIO(body), tag))
+    objects = (time.time() - start) / repeat
+    start = time.time()
+    for i in xrange(repeat):
+        pycast.TopList._parse(tag, pycast._iterparse(StringIO(body), tag),
+                              session)
+    columnar = (time.time() - start) / repeat
+    return {'items': items, 'bytes': len(body),
+            'parse_ms': objects * 1000, 'columnar_parse_ms': columnar * 1000}
+
+
+def _child(queue, function, args):
+    start_rss = _max_rss()
+    try:
+        result = function(*args)
+    except Exception, e:
+        queue.put({'error': '%s: %s' % (e.__class__.__name__, e)})
+        return
+    result['peak_rss_kb'] = _max_rss()
+    result['rss_growth_kb'] = result['peak_rss_kb'] - start_rss
+    queue.put(result)
+
+
+def _isolated(function, *args):
+    """Runs a function in a forked process and returns its result."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_child, args=(queue, function, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def run(args):
+    server = MockServer(items=args.items, total_matches=args.matches,
+                        latency=args.latency / 1000.0,
+                        compress=args.gzip).start()
+    pycast.WS_SERVER = server.get_ws_server()
+    results = {}
+    try:
+        for name, call in REQUESTS:
+            if args.only and args.only not in name:
+                continue
+            for concurrency in args.concurrency:
+                key = '%s@%d' % (name, concurrency)
+                sys.stderr.write('%s...\n' % key)
+                results[key] = _isolated(
+                    _run_requests, call, args.requests, concurrency)
+        for name, render, tag, build in PARSES:
+            if args.only and args.only not in name:
+                continue
+            sys.stderr.write('%s...\n' % name)
+            results[name] = _isolated(
+                _run_parse, render, tag, build, args.items, args.repeat)
+    finally:
+        server.stop()
+    return {'version': pycast.__version__,
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {'items': args.items, 'matches': args.matches,
+                       'latency_ms': args.latency, 'gzip': args.gzip,
+                       'requests': args.requests, 'repeat': args.repeat},
+            'results': results}
+
+
+# Metrics compared between reports, and whether higher values are better.
+METRICS = (('rps', True), ('p50_ms', False), ('p99_ms', False),
+           ('parse_ms', False), ('columnar_parse_ms', False),
+           ('rss_growth_kb', False))
+
+
+def compare(old, new, threshold):
+    """Returns a list of (scenario, metric, old, new, change) for the
+    metrics that got worse by more than `threshold` percent."""
+    regressions = []
+    for key, result in sorted(new['results'].items()):
+        previous = old['results'].get(key)
+        if previous is None or 'error' in result or 'error' in previous:
+            continue
+        for metric, higher_is_better in METRICS:
+            if metric not in result or not previous.get(metric):
+                continue
+            change = (result[metric] - previous[metric]) / float(
+                previous[metric]) * 100
+            worse = higher_is_better and -change or change
+            if worse > threshold:
+                regressions.append(
+                    (key, metric, previous[metric], result[metric], change))
+    return regressions
+
+
+def print_report(report):
+    print 'pycast %s, Python %s, %s' % (
+        report['version'], report['python'], report['config'])
+    print '%-40s %9s %9s %9s %9s %9s %9s' % (
+        'scenario', 'rps', 'p50 ms', 'p99 ms', 'parse ms', 'col. ms',
+        'peak KB')
+    for key, result in sorted(report['results'].items()):
+        if 'error' in result:
+            print '%-40s %s' % (key, result['error'])
+            continue
+        print '%-40s %9s %9s %9s %9s %9s %9d' % (
+            key, _format(result.get('rps')), _format(result.get('p50_ms')),
+            _format(result.get('p99_ms')), _format(result.get('parse_ms')),
+            _format(result.get('columnar_parse_ms')), result['peak_rss_kb'])
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    return '%.2f' % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pycast')
+    parser.add_argument('--items', type=int, default=50,
+                        help='Elements of top listings')
+    parser.add_argument('--matches', type=int, default=500,
+                        help='Matches over all pages')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Milliseconds the server delays responses')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Make the server compress its responses')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 8], help='Threads sending requests')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='Parses per parse scenario')
+    parser.add_argument('--only', help='Run the scenarios with this text')
+    parser.add_argument('--output', help='File to save the report in')
+    parser.add_argument('--compare', help='Older report to compare with')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Percent a metric may worsen')
+    args = parser.parse_args()
+    report = run(args)
+    print_report(report)
+    if args.output:
+        output = open(args.output, 'w')
+        try:
+            json.dump(report, output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+    if args.compare:
+        old = json.load(open(args.compare))
+        regressions = compare(old, report, args.threshold)
+        print
+        print 'Compared with pycast %s of %s:' % (old['version'], old['date'])
+        if old['config'] != report['config']:
+            print '  warning: the reports were run with other options'
+        for key, metric, before, after, change in regressions:
+            print '  %s %s: %.2f -> %.2f (%+.1f%%)' % (
+                key, metric, before, after, change)
+        if not regressions:
+            print '  no regressions over %g%%' % args.threshold
+        return regressions and 1 or 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#-*- coding: utf-8 -*-
+# XML responses of the Vericast web service, in the shape the real one
+# returns them, with as many elements as asked for.
+
+import datetime
+
+
+ARTISTS = (u'Madonna', u'Björk', u'Sigur Rós', u'The Beatles', u'Rosalía',
+           u'Daft Punk', u'Beyoncé', u'Manu Chao', u'Radiohead', u'Adele')
+CHANNELS = ('gb-radio-bbc-radio-1----------01',
+            'gb-radio-bbc-radio-2----------01',
+            'es-radio-los-40-principales---01',
+            'fr-radio-nrj------------------01',
+            'de-tv-mtv-germany-------------01')
+MEDIA = ('Radio FM', 'Radio AM', 'TV')
+
+
+def _escape(text):
+    return (text.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+            .replace(u'>', u'&gt;'))
+
+
+def _response(body):
+    return (u'<?xml version="1.0" encoding="utf-8"?>\n'
+            u'<response status="ok">%s</response>' % body).encode('utf8')
+
+
+def _artist(index):
+    return u'%s %d' % (ARTISTS[index % len(ARTISTS)], index)
+
+
+def _track(index):
+    return u'Song number %d (Radio Edit)' % index
+
+
+def _playcount(index, items):
+    return (items - index) * 37
+
+
+def top_artists(items):
+    return _response(u'<artists>%s</artists>' % u''.join(
+        u'<artist rank="%d"><name>%s</name><playcount>%d</playcount>'
+        u'</artist>' % (i + 1, _escape(_artist(i)), _playcount(i, items))
+        for i in xrange(items)))
+
+
+def top_tracks(items):
+    return _response(u'<tracks>%s</tracks>' % u''.join(
+        u'<track rank="%d"><name>%s</name><artist><name>%s</name></artist>'
+        u'<playcount>%d</playcount></track>' % (
+            i + 1, _escape(_track(i)), _escape(_artist(i % 97)),
+            _playcount(i, items))
+        for i in xrange(items)))
+
+
+def top_channels(items):
+    return _response(u'<channels>%s</channels>' % u''.join(
+        u'<channel rank="%d"><keyname>%s-%d</keyname><playcount>%d'
+        u'</playcount></channel>' % (
+            i + 1, CHANNELS[i % len(CHANNELS)], i, _playcount(i, items))
+        for i in xrange(items)))
+
+
+def top_labels(items):
+    return _response(u'<labels>%s</labels>' % u''.join(
+        u'<label rank="%d"><name>Label %d Records</name><playcount>%d'
+        u'</playcount></label>' % (i + 1, i, _playcount(i, items))
+        for i in xrange(items)))
+
+
+def _match(id, index):
+    time = datetime.datetime(2012, 3, 4) + datetime.timedelta(
+        minutes=index * 3)
+    return (u'<match><id>%s</id><datetime>%s</datetime>'
+            u'<duration>%d</duration><channel><keyname>%s</keyname>'
+            u'</channel><track><name>%s</name><artist><name>%s</name>'
+            u'</artist></track></match>' % (
+                id, time.isoformat(), 150 + index % 120,
+                CHANNELS[index % len(CHANNELS)], _escape(_track(index)),
+                _escape(_artist(index % 97))))
+
+
+def matches(page, limit, total):
+    first = (page - 1) * limit
+    count = max(0, min(limit, total - first))
+    return _response(u'<matches page="%d" total="%d">%s</matches>' % (
+        page, total, u''.join(
+            _match(u'%d' % (first + i), first + i) for i in xrange(count))))
+
+
+def match_info(id):
+    index = int(id) if id.isdigit() else 0
+    return _response(_match(id, index))
+
+
+def channel_info(keyname):
+    index = sum(ord(char) for char in keyname)
+    return _response(
+        u'<channel><keyname>%s</keyname><name>%s</name>'
+        u'<website>http://www.example.com/%s</website><media>%s</media>'
+        u'</channel>' % (_escape(keyname), _escape(keyname.split('-')[2]),
+                         _escape(keyname), MEDIA[index % len(MEDIA)]))
+
+
+def error(code, message):
+    return (u'<?xml version="1.0" encoding="utf-8"?>\n'
+            u'<response status="failed"><error code="%s">%s</error>'
+            u'</response>' % (code, _escape(message))).encode('utf8')
+
+
+LISTINGS = {'topartists': top_artists, 'toptracks': top_tracks,
+            'topchannels': top_channels, 'toplabels': top_labels}
+
+
+def render(method, params, items=50, total_matches=500):
+    """Returns the body of the response to a web service method."""
+    scope, _, name = method.partition('/')
+    if method == 'match/info':
+        return match_info(params.get('match', '0'))
+    if method == 'channel/info':
+        return channel_info(params.get('channel', CHANNELS[0]))
+    if name == 'matches' and scope in ('artist', 'track', 'channel',
+                                       'label'):
+        return matches(int(params.get('page', 1)),
+                       int(params.get('limit', 50)), total_matches)
+    if name in LISTINGS and scope in ('artist', 'track', 'channel', 'label',
+                                      'charts'):
+        return LISTINGS[name](items)
+    return error(3, 'Invalid method')
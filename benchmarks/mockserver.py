@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# A local stand-in for the Vericast web service, serving the responses of
+# fixtures.py with a chosen size and latency. Run it on its own with
+# "python benchmarks/mockserver.py --port 8080" or start it from bench.py.
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import gzip
+import threading
+import time
+import urlparse
+from cStringIO import StringIO
+
+import fixtures
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, without waiting for delayed ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        # Paths look like /1/artist/toptracks.
+        method = url.path.split('/', 2)[-1]
+        body = fixtures.render(method, params, server.items,
+                               server.total_matches)
+        if server.latency:
+            time.sleep(server.latency)
+        server.count()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        if server.compress and 'gzip' in self.headers.get(
+                'Accept-Encoding', ''):
+            body = _gzip(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _gzip(body):
+    buffer = StringIO()
+    compressed = gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6)
+    compressed.write(body)
+    compressed.close()
+    return buffer.getvalue()
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP/1.1 server answering like the Vericast web service.
+
+    `items` is the number of elements of top listings, `total_matches` the
+    number of matches over all pages and `latency` the seconds every
+    response is delayed. With `compress`, responses are gzipped for the
+    clients that accept it."""
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port=0, items=50, total_matches=500, latency=0,
+                 compress=False):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', port), _Handler)
+        self.items = items
+        self.total_matches = total_matches
+        self.latency = latency
+        self.compress = compress
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count(self):
+        self._lock.acquire()
+        self.requests += 1
+        self._lock.release()
+
+    def get_ws_server(self):
+        """Returns the value of pycast.WS_SERVER to use this server."""
+        return '127.0.0.1:%d/1/' % self.server_address[1]
+
+    def start(self):
+        """Serves requests on a daemon thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve fake Vericast responses')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--items', type=int, default=50,
+                        help='Elements of top listings')
+    parser.add_argument('--matches', type=int, default=500,
+                        help='Matches over all pages')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Milliseconds every response is delayed')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Compress the responses')
+    args = parser.parse_args()
+    server = MockServer(args.port, args.items, args.matches,
+                        args.latency / 1000.0, args.gzip)
+    print 'Set pycast.WS_SERVER = %r' % server.get_ws_server()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
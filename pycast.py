@@ -21,11 +21,56 @@
 #
 
 import os
+import BaseHTTPServer
+import SocketServer
+import base64
+import bisect
+import copy
+import csv
+import errno
+import gzip
+import json
+import mmap
+import pickle
+import random
+import select
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 import urllib
 import urllib2
-from xml.dom import minidom
+import urlparse
+import httplib
+import weakref
+import zlib
+from cStringIO import StringIO
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+import datetime
+from array import array
 from hashlib import md5
 from dateutil.parser import parse as parse_date
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __name__ = 'pycast'
@@ -40,17 +85,50 @@ __email__ = 'vericast-support@bmat.com'
 WS_SERVER = "api.ramone.bmat.srv/1/"
 
 
-__cache_dir = None
 __cache_enabled = None
+__cache_backend = None
+
+__connection_pool = None
+__connection_pool_lock = threading.Lock()
+
+__memory_cache = None
+
+__recent_ttl = 300
+
+__sessions = {}
+__sessions_lock = threading.Lock()
+
+__channel_catalog = None
+__series_store = None
+
+__transport_policy = None
+__credential_pool = None
+
+__request_timeout = None
+__deadlines = threading.local()
+__hedger = None
+__request_stats = {'timeouts': 0}
+__request_stats_lock = threading.Lock()
+
+__metrics = None
+__metrics_enabled = True
+__metrics_lock = threading.Lock()
+__hooks = []
+
+__proxy = None
 
 
 DAY, WEEK, MONTH = range(1, 4)
 
+# Type code of the arrays of playcounts when NumPy is not installed.
+_INT64_CODE = array('l').itemsize == 8 and 'l' or 'd'
+
 
 class ServiceException(Exception):
     """Exception related to the Vericast web service"""
 
     def __init__(self, code, message):
+        Exception.__init__(self, code, message)
         self._code = code
         self._message = message
 
@@ -58,7 +136,1661 @@ class ServiceException(Exception):
         return self._message
 
     def get_id(self):
-        return self.code
+        return self._code
+
+
+class CircuitOpenError(ServiceException):
+    """Raised without sending the request while the service is failing."""
+
+
+class DeadlineExceeded(ServiceException):
+    """Raised when a request doesn't complete before its deadline."""
+
+
+# Redirects followed by a request, like urllib2.
+_MAX_REDIRECTS = 10
+
+
+class _PooledResponse(object):
+    """A HTTP response whose connection goes back to the pool once closed."""
+
+    def __init__(self, pool, host, connection, response):
+        self._pool = pool
+        self._host = host
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def set_timeout(self, timeout):
+        """Sets the timeout of the following socket operations."""
+        _set_timeout(self._connection, timeout)
+
+    def close(self):
+        """Releases the connection, keeping it alive if it can be reused."""
+        if self._connection is None:
+            return
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._pool._release(self._host, self._connection, reusable)
+        self._connection = None
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+    """A HTTP connection to a unix socket, for hosts like 'unix:/path'."""
+
+    def __init__(self, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = host[len('unix:'):]
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+def _http_connection(host):
+    """Returns a new connection to a 'host:port' or 'unix:/path'."""
+    if host.startswith('unix:'):
+        return _UnixHTTPConnection(host)
+    return httplib.HTTPConnection(host)
+
+
+class _ConnectionPool(object):
+    """A bounded pool of persistent HTTP/1.1 connections.
+
+    The pool is shared by every request and safe to use from several
+    threads. At most `size` connections exist at once; callers block when
+    all of them are busy. Idle connections older than `idle_timeout`
+    seconds are closed instead of being reused.
+
+    Like urllib2, requests go through the HTTP proxy of the environment
+    (http_proxy, no_proxy) and follow redirects to HTTP URLs.
+    """
+
+    def __init__(self, size=10, idle_timeout=60):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.proxies = urllib.getproxies()
+        self.pid = os.getpid()
+        self._lock = threading.Condition()
+        self._idle = []
+        self._in_use = 0
+        self._stats = {'requests': 0, 'created': 0, 'reused': 0,
+                       'discarded': 0, 'expired': 0, 'waits': 0}
+
+    def _expire(self, now):
+        """Closes the idle connections past the idle timeout."""
+        alive = []
+        for host, connection, last_used in self._idle:
+            if now - last_used > self.idle_timeout:
+                connection.close()
+                self._stats['expired'] += 1
+            else:
+                alive.append((host, connection, last_used))
+        self._idle = alive
+
+    def _acquire(self, host, timeout=None):
+        """Returns a (connection, reused) pair for the given host, raising
+        socket.timeout if none is free within `timeout` seconds."""
+        if timeout is not None:
+            end = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while self._in_use >= self.size:
+                self._stats['waits'] += 1
+                if timeout is None:
+                    self._lock.wait()
+                    continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('timed out waiting for a connection')
+                self._lock.wait(remaining)
+            self._expire(time.time())
+            self._in_use += 1
+            self._stats['requests'] += 1
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == host:
+                    connection = self._idle.pop(i)[1]
+                    self._stats['reused'] += 1
+                    return connection, True
+            if self._idle and self._in_use + len(self._idle) > self.size:
+                self._idle.pop(0)[1].close()
+                self._stats['discarded'] += 1
+            self._stats['created'] += 1
+        finally:
+            self._lock.release()
+        return _http_connection(host), False
+
+    def _release(self, host, connection, reusable):
+        self._lock.acquire()
+        try:
+            self._in_use -= 1
+            if reusable:
+                self._idle.append((host, connection, time.time()))
+            else:
+                connection.close()
+                self._stats['discarded'] += 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def urlopen(self, host, path, headers, timeout=None):
+        """Sends a GET request and returns a _PooledResponse.
+
+        Waiting for a connection, connecting and reading the response
+        headers must take less than `timeout` seconds in all, redirects
+        included. The response must be closed to give the connection
+        back."""
+        if timeout is not None:
+            end = time.time() + timeout
+        for redirects in xrange(_MAX_REDIRECTS + 1):
+            response = self._open(host, path, headers, timeout)
+            location = (response.status in (301, 302, 303, 307) and
+                        response.msg.get('location'))
+            if not location or redirects == _MAX_REDIRECTS:
+                return response
+            url = urlparse.urlsplit(urlparse.urljoin(path, location))
+            if url.scheme not in ('', 'http'):
+                return response
+            # Read the body to reuse the connection.
+            response.read()
+            response.close()
+            host = url.netloc or host
+            path = urlparse.urlunsplit(('', '', url.path or '/', url.query,
+                                        ''))
+            if timeout is not None:
+                timeout = max(end - time.time(), 0.001)
+
+    def _proxy(self, host):
+        """Returns the (proxy host, headers) to send the requests for
+        `host` through, or None to connect to it."""
+        proxy = self.proxies.get('http')
+        if not proxy or host.startswith('unix:'):
+            return None
+        if urllib.proxy_bypass(host.partition(':')[0]):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        credentials, _, address = urlparse.urlsplit(
+            proxy).netloc.rpartition('@')
+        headers = {}
+        if credentials:
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                urllib.unquote(credentials))
+        return address, headers
+
+    def _open(self, host, path, headers, timeout=None):
+        proxy = self._proxy(host)
+        if proxy is not None:
+            path = 'http://' + host + path
+            host, proxy_headers = proxy
+            headers = dict(headers, **proxy_headers)
+        if timeout is not None:
+            end = time.time() + timeout
+        connection, reused = self._acquire(host, timeout)
+        try:
+            # A reused connection keeps the timeout of its last request.
+            if timeout is not None:
+                timeout = max(end - time.time(), 0.001)
+            _set_timeout(connection, timeout)
+            try:
+                connection.request('GET', path, None, headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    raise
+                # The server closed the kept-alive connection while it was
+                # idle, try once again on a fresh one.
+                connection.close()
+                self._lock.acquire()
+                self._stats['discarded'] += 1
+                self._stats['created'] += 1
+                self._lock.release()
+                connection = _http_connection(host)
+                if timeout is not None:
+                    _set_timeout(connection, max(end - time.time(), 0.001))
+                connection.request('GET', path, None, headers)
+                response = connection.getresponse()
+        except:
+            self._release(host, connection, False)
+            raise
+        return _PooledResponse(self, host, connection, response)
+
+    def clear(self):
+        """Closes every idle connection."""
+        self._lock.acquire()
+        try:
+            for host, connection, last_used in self._idle:
+                connection.close()
+            self._idle = []
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """Returns a dict with the pool counters."""
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['in_use'] = self._in_use
+            stats['idle'] = len(self._idle)
+            stats['size'] = self.size
+            return stats
+        finally:
+            self._lock.release()
+
+
+class _AsyncConnection(object):
+    """A non-blocking HTTP/1.1 connection driven by _AsyncTransport."""
+
+    def __init__(self, host):
+        # The pool key of the connection, and the Host header it sends.
+        self.host = self.host_header = host
+        if host.startswith('unix:'):
+            self.family = socket.AF_UNIX
+            self.address = host[len('unix:'):]
+            self.host_header = 'localhost'
+        else:
+            name, _, port = host.partition(':')
+            self.family = socket.AF_INET
+            self.address = (name, int(port or 80))
+        self.sock = None
+        self.job = None
+        self.last_used = time.time()
+
+    def start(self, job):
+        """Starts sending the request of a (path, headers, deferred, at)
+        job, where `at` is its deadline or None."""
+        path, headers, deferred, at = job
+        self.job = job
+        self.reused = self.sock is not None
+        if self.sock is None:
+            self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(self.address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                           errno.EAGAIN):
+                raise socket.error(err, os.strerror(err))
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % self.host_header]
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        self.output = '\r\n'.join(lines) + '\r\n\r\n'
+        self.buffer = ''
+        self.status = None
+        self.body = []
+        self.received = False
+
+    def send(self):
+        sent = self.sock.send(self.output)
+        self.output = self.output[sent:]
+
+    def receive(self):
+        """Reads from the socket, returns True once the response is done."""
+        data = self.sock.recv(65536)
+        if not data:
+            if self.status is not None and self.length is None:
+                self.keep_alive = False
+                return True
+            raise httplib.IncompleteRead(''.join(self.body))
+        self.received = True
+        self.buffer += data
+        if self.status is None:
+            end = self.buffer.find('\r\n\r\n')
+            if end < 0:
+                return False
+            self._read_head(self.buffer[:end])
+            self.buffer = self.buffer[end + 4:]
+        if self.chunked:
+            return self._read_chunks()
+        if self.length is not None:
+            self.body.append(self.buffer)
+            self.length -= len(self.buffer)
+            self.buffer = ''
+            return self.length <= 0
+        self.body.append(self.buffer)
+        self.buffer = ''
+        return False
+
+    def _read_head(self, head):
+        lines = head.split('\r\n')
+        version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+        self.status = int(status)
+        self.reason = reason
+        self.headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        self.keep_alive = (version == 'HTTP/1.1' and
+                           self.headers.get('connection') != 'close')
+        self.chunked = 'chunked' in self.headers.get('transfer-encoding', '')
+        self.length = self.headers.get('content-length')
+        if self.length is not None:
+            self.length = int(self.length)
+        if self.status < 200 or self.status in (204, 304):
+            # These responses never have a body.
+            self.length = 0
+            self.chunked = False
+        self.chunk = None
+        self.body = []
+
+    def _read_chunks(self):
+        while True:
+            if self.chunk is None:
+                end = self.buffer.find('\r\n')
+                if end < 0:
+                    return False
+                self.chunk = int(self.buffer[:end].split(';')[0], 16)
+                self.buffer = self.buffer[end + 2:]
+            if self.chunk == 0:
+                # Trailers are ignored, the response ends with a blank line.
+                end = self.buffer.find('\r\n')
+                if end < 0:
+                    return False
+                if end == 0:
+                    return True
+                self.buffer = self.buffer[end + 2:]
+                continue
+            if len(self.buffer) < self.chunk + 2:
+                return False
+            self.body.append(self.buffer[:self.chunk])
+            self.buffer = self.buffer[self.chunk + 2:]
+            self.chunk = None
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class _AsyncTransport(object):
+    """A non-blocking HTTP/1.1 transport.
+
+    A single background thread multiplexes every request with select(),
+    keeping up to `max_in_flight` of them running at once and reusing
+    idle connections to the same host."""
+
+    def __init__(self, max_in_flight=100, idle_timeout=60):
+        self.max_in_flight = max_in_flight
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._idle = {}
+        self._active = []
+        self._thread = None
+        self._closed = False
+        self._wake_read, self._wake_write = os.pipe()
+        self._stats = {'requests': 0, 'created': 0, 'reused': 0,
+                       'retried': 0, 'errors': 0}
+
+    def fetch(self, host, path, headers, at=None):
+        """Queues a GET request and returns a Deferred of its response,
+        a (status, reason, headers, body) tuple. The Deferred fails with
+        DeadlineExceeded if the response isn't read by the time `at`."""
+        deferred = Deferred()
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise ValueError('The transport is closed')
+            self._queue.append((host, (path, headers, deferred, at)))
+            self._stats['requests'] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            # Under the lock, the thread can't close the pipe meanwhile.
+            os.write(self._wake_write, 'x')
+        finally:
+            self._lock.release()
+        return deferred
+
+    def close(self):
+        """Stops the transport once the running requests are done."""
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is None:
+                self._close_pipe()
+            else:
+                os.write(self._wake_write, 'x')
+        finally:
+            self._lock.release()
+
+    def _close_pipe(self):
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        self._wake_read = self._wake_write = None
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._active)
+            stats['queued'] = len(self._queue)
+            stats['idle'] = sum(map(len, self._idle.values()))
+            return stats
+        finally:
+            self._lock.release()
+
+    def _start_queued(self):
+        while len(self._active) < self.max_in_flight:
+            self._lock.acquire()
+            try:
+                if not self._queue:
+                    return
+                host, job = self._queue.popleft()
+                idle = self._idle.get(host)
+                if idle:
+                    connection = idle.pop()
+                    self._stats['reused'] += 1
+                else:
+                    connection = _AsyncConnection(host)
+                    self._stats['created'] += 1
+            finally:
+                self._lock.release()
+            try:
+                connection.start(job)
+            except Exception, e:
+                connection.close()
+                self._fail(job, e)
+                continue
+            self._active.append(connection)
+
+    def _expire(self):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for host, connections in self._idle.items():
+                for connection in connections[:]:
+                    if now - connection.last_used > self.idle_timeout:
+                        connection.close()
+                        connections.remove(connection)
+        finally:
+            self._lock.release()
+
+    def _expire_overdue(self):
+        """Fails the requests past their deadline and returns the seconds
+        until the next deadline, or None."""
+        now = time.time()
+        overdue = []
+        self._lock.acquire()
+        try:
+            for host, job in list(self._queue):
+                if job[3] is not None and job[3] <= now:
+                    self._queue.remove((host, job))
+                    overdue.append(job)
+        finally:
+            self._lock.release()
+        for connection in self._active[:]:
+            at = connection.job[3]
+            if at is not None and at <= now:
+                self._active.remove(connection)
+                connection.close()
+                overdue.append(connection.job)
+        for job in overdue:
+            _count_request('timeouts')
+            self._fail(job, DeadlineExceeded(None, 'Deadline exceeded'))
+        self._lock.acquire()
+        try:
+            deadlines = [job[3] for host, job in self._queue
+                         if job[3] is not None]
+        finally:
+            self._lock.release()
+        deadlines.extend(connection.job[3] for connection in self._active
+                         if connection.job[3] is not None)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def _run(self):
+        while True:
+            self._start_queued()
+            self._expire()
+            timeout = self._expire_overdue()
+            if timeout is None or timeout > self.idle_timeout:
+                timeout = self.idle_timeout
+            self._lock.acquire()
+            done = self._closed and not self._active and not self._queue
+            self._lock.release()
+            if done:
+                break
+            readers = [self._wake_read]
+            writers = []
+            for connection in self._active:
+                if connection.output:
+                    writers.append(connection.sock)
+                else:
+                    readers.append(connection.sock)
+            readable, writable, _ = select.select(
+                readers, writers, [], timeout)
+            if self._wake_read in readable:
+                os.read(self._wake_read, 4096)
+            for connection in self._active[:]:
+                try:
+                    if connection.sock in writable:
+                        connection.send()
+                    elif connection.sock in readable:
+                        if connection.receive():
+                            self._finish(connection)
+                except Exception, e:
+                    # Any error fails the request, not the transport thread
+                    # every other request depends on.
+                    if connection not in self._active:
+                        # Finished, the error came from a callback.
+                        continue
+                    self._active.remove(connection)
+                    connection.close()
+                    if (connection.reused and not connection.received and
+                            isinstance(e, (socket.error,
+                                           httplib.HTTPException))):
+                        # The server closed the kept-alive connection while
+                        # it was idle, try once again on a fresh one.
+                        self._lock.acquire()
+                        self._queue.appendleft((connection.host,
+                                                connection.job))
+                        self._stats['retried'] += 1
+                        self._lock.release()
+                    else:
+                        self._fail(connection.job, e)
+        self._lock.acquire()
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle = {}
+        self._close_pipe()
+        self._lock.release()
+
+    def _finish(self, connection):
+        self._active.remove(connection)
+        path, headers, deferred, at = connection.job
+        response = (connection.status, connection.reason, connection.headers,
+                    ''.join(connection.body))
+        connection.job = None
+        if connection.keep_alive:
+            connection.last_used = time.time()
+            self._lock.acquire()
+            self._idle.setdefault(connection.host, []).append(connection)
+            self._lock.release()
+        else:
+            connection.close()
+        deferred._set_result(response)
+
+    def _fail(self, job, error):
+        self._lock.acquire()
+        self._stats['errors'] += 1
+        self._lock.release()
+        job[2]._set_exception(error)
+
+
+class _MemoryCache(object):
+    """A thread-safe in-memory LRU cache of parsed responses.
+
+    Holds at most `max_entries` entries and `max_bytes` bytes, measured by
+    the size of the responses they were parsed from. Entries expire after
+    `ttl` seconds, None meaning never."""
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024,
+                 ttl=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'expirations': 0}
+
+    def get(self, key):
+        """Returns the value stored for key or None."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            value, size, expires = entry
+            if expires is not None and expires < time.time():
+                self._bytes -= size
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries[key] = entry
+            self._stats['hits'] += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size, ttl=None):
+        """Stores a value, evicting the least recently used entries."""
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        if size > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, expires)
+            self._bytes += size
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                evicted = self._entries.popitem(last=False)[1]
+                self._bytes -= evicted[1]
+                self._stats['evictions'] += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        self._entries.clear()
+        self._bytes = 0
+        self._lock.release()
+
+    def get_stats(self):
+        """Returns a dict with the cache counters."""
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            return stats
+        finally:
+            self._lock.release()
+
+
+class CacheBackend(object):
+    """The interface of the response caches used by enable_caching.
+
+    Backends store response bodies by cache key and must be safe to use
+    from several threads."""
+
+    def get(self, key):
+        """Returns the response stored for key or None"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Stores a response, for `ttl` seconds or for ever if None"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Removes a response from the cache"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes every response from the cache"""
+        raise NotImplementedError
+
+
+class DiskCache(CacheBackend):
+    """A cache of compressed files sharded in subdirectories.
+
+    Files are written atomically, so several processes can share the same
+    directory. When the files take more than `max_size` bytes, the least
+    recently used ones are removed."""
+
+    # Number of writes between two checks of the real size on disk, which
+    # other processes sharing the directory also change.
+    check_interval = 1000
+
+    def __init__(self, cache_dir, max_size=1024 ** 3, compress=True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._size = None
+        self._writes = 0
+        _makedirs(cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:4], key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            cache_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            header = cache_file.readline()
+            value = cache_file.read()
+        finally:
+            cache_file.close()
+        try:
+            expires, compressed = map(int, header.split())
+            if compressed:
+                value = zlib.decompress(value)
+        except (ValueError, zlib.error):
+            return None
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        try:
+            # The modification time tracks the last use of the entry.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value, ttl=None):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        expires = 0
+        if ttl is not None:
+            expires = int(time.time() + ttl)
+        compressed = int(self.compress)
+        if compressed:
+            value = zlib.compress(value)
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            temp_file = os.fdopen(handle, 'wb')
+            try:
+                temp_file.write('%d %d\n' % (expires, compressed))
+                temp_file.write(value)
+            finally:
+                temp_file.close()
+            # Overwriting an entry only adds the difference in size.
+            size = _file_size(temp_path) - _file_size(path)
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+        self._track(size)
+
+    def delete(self, key):
+        path = self._path(key)
+        size = _file_size(path)
+        _remove(path)
+        self._track(-size, False)
+
+    def clear(self):
+        for path, size, used in self._walk():
+            _remove(path)
+        self._lock.acquire()
+        self._size = 0
+        self._lock.release()
+
+    def _track(self, size, write=True):
+        """Accounts a change in size and evicts entries if the cache is too
+        big."""
+        if self.max_size is None:
+            return
+        self._lock.acquire()
+        try:
+            if self._size is not None:
+                self._size += size
+            if not write:
+                return
+            self._writes += 1
+            check = (self._size is None or self._size > self.max_size or
+                     self._writes % self.check_interval == 0)
+        finally:
+            self._lock.release()
+        if check:
+            self._evict()
+
+    def _walk(self):
+        """Yields the (path, size, last use) of every entry."""
+        now = time.time()
+        for directory, subdirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith('.tmp'):
+                    # Left behind by a writer that died.
+                    if now - info.st_mtime > 3600:
+                        _remove(path)
+                    continue
+                if name == '.lock':
+                    continue
+                yield path, info.st_size, info.st_mtime
+
+    def _evict(self):
+        """Removes the least recently used entries down to 90% of the
+        maximum size, unless another process is already doing it."""
+        lock_file = open(os.path.join(self.cache_dir, '.lock'), 'a')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return
+            entries = list(self._walk())
+            size = sum(entry[1] for entry in entries)
+            if size > self.max_size:
+                entries.sort(key=lambda entry: entry[2])
+                for path, entry_size, used in entries:
+                    if size <= self.max_size * 0.9:
+                        break
+                    _remove(path)
+                    size -= entry_size
+            self._lock.acquire()
+            self._size = size
+            self._lock.release()
+        finally:
+            lock_file.close()
+
+
+class SQLiteCache(CacheBackend):
+    """A cache kept in a single SQLite database file.
+
+    Scales to millions of entries without loading the filesystem, and can
+    be shared by several processes. When the responses take more than
+    `max_size` bytes, the least recently used ones are removed."""
+
+    check_interval = 1000
+
+    def __init__(self, path, max_size=1024 ** 3, compress=True):
+        if sqlite3 is None:
+            raise ImportError('SQLiteCache needs the sqlite3 module')
+        self.path = path
+        self.max_size = max_size
+        self.compress = compress
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._size = None
+        self._writes = 0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+            'value BLOB, compressed INTEGER, expires REAL, used REAL, '
+            'size INTEGER)')
+        self._connection().execute(
+            'CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+
+    def _connection(self):
+        """Returns the connection of the current thread and process."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, compressed, expires FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        value, compressed, expires = row
+        now = time.time()
+        if expires is not None and expires < now:
+            self.delete(key)
+            return None
+        connection.execute(
+            'UPDATE cache SET used = ? WHERE key = ?', (now, key))
+        value = str(value)
+        if compressed:
+            value = zlib.decompress(value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires = None
+        if ttl is not None:
+            expires = now + ttl
+        if self.compress:
+            value = zlib.compress(value)
+        connection = self._connection()
+        replaced = connection.execute(
+            'SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+            (key, buffer(value), int(self.compress), expires, now,
+             len(value)))
+        if self.max_size is None:
+            return
+        self._lock.acquire()
+        try:
+            self._writes += 1
+            if self._size is not None:
+                self._size += len(value) - (replaced and replaced[0] or 0)
+            check = (self._size is None or self._size > self.max_size or
+                     self._writes % self.check_interval == 0)
+        finally:
+            self._lock.release()
+        if check:
+            self._evict()
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+        self._lock.acquire()
+        self._size = 0
+        self._lock.release()
+
+    def _evict(self):
+        """Removes the least recently used entries down to 90% of the
+        maximum size."""
+        connection = self._connection()
+        size = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if size > self.max_size:
+            keys = []
+            for key, entry_size in connection.execute(
+                    'SELECT key, size FROM cache ORDER BY used'):
+                if size <= self.max_size * 0.9:
+                    break
+                keys.append((key,))
+                size -= entry_size
+            connection.executemany('DELETE FROM cache WHERE key = ?', keys)
+        self._lock.acquire()
+        self._size = size
+        self._lock.release()
+
+
+class _SingleFlight(object):
+    """Coalesces identical calls running at the same time.
+
+    Only the first caller for a key runs the function, the others wait
+    and get its result or its exception."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, function, timeout=None):
+        """Returns function(), or the result of the identical call already
+        running, waiting for it at most `timeout` seconds."""
+        self._lock.acquire()
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = Deferred()
+        else:
+            self.coalesced += 1
+        self._lock.release()
+        if not leader:
+            return call.result(timeout)
+        value = error = None
+        try:
+            try:
+                value = function()
+            except Exception, e:
+                error = e
+                raise
+            except:
+                # KeyboardInterrupt or SystemExit belong to this thread,
+                # the waiting ones get an error of their own.
+                error = ServiceException(None, 'The request was interrupted')
+                raise
+        finally:
+            self._forget(key)
+            if error is None:
+                call._set_result(value)
+            else:
+                call._set_exception(error)
+        return value
+
+    def _forget(self, key):
+        self._lock.acquire()
+        del self._calls[key]
+        self._lock.release()
+
+
+_single_flight = _SingleFlight()
+
+
+class _TokenBucket(object):
+    """Lets through `rate` calls per second, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits for a token. Returns True if it had to wait."""
+        waited = False
+        while True:
+            delay = self.take()
+            if not delay:
+                return waited
+            waited = True
+            time.sleep(delay)
+
+    def take(self):
+        """Takes a token if there is one and returns 0, otherwise returns
+        the seconds until there will be one."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+        finally:
+            self._lock.release()
+
+
+class _CircuitBreaker(object):
+    """Opens after `threshold` consecutive failures and rejects calls for
+    `timeout` seconds. Then a single trial call decides whether it closes
+    again or stays open for another timeout."""
+
+    def __init__(self, threshold=5, timeout=30):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = 'closed'
+        self._failures = 0
+        self._opened = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        self._lock.acquire()
+        try:
+            if self.state == 'open':
+                if time.time() - self._opened < self.timeout:
+                    return False
+                self.state = 'half-open'
+            if self.state == 'half-open':
+                if self._trial:
+                    return False
+                self._trial = True
+            return True
+        finally:
+            self._lock.release()
+
+    def success(self):
+        self._lock.acquire()
+        self.state = 'closed'
+        self._failures = 0
+        self._trial = False
+        self._lock.release()
+
+    def cancel(self):
+        """Forgets a call allowed through that ended without telling
+        whether the service is healthy, so another one can try."""
+        self._lock.acquire()
+        self._trial = False
+        self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        self._failures += 1
+        if self.state == 'half-open' or self._failures >= self.threshold:
+            self.state = 'open'
+            self._opened = time.time()
+        self._trial = False
+        self._lock.release()
+
+
+class _AdaptiveLimiter(object):
+    """Limits the calls running at once. The limit grows by one for every
+    `limit` successful calls and halves when the service throttles us."""
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self._in_use = 0
+        self._lock = threading.Condition()
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            while self._in_use >= int(self.limit):
+                self._lock.wait()
+            self._in_use += 1
+        finally:
+            self._lock.release()
+
+    def release(self, throttled):
+        self._lock.acquire()
+        try:
+            self._in_use -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._lock.notify_all()
+        finally:
+            self._lock.release()
+
+
+class _TransportPolicy(object):
+    """Rate limits, retries, circuit breaking and adaptive concurrency
+    around the requests sent to the server."""
+
+    def __init__(self, rate=None, burst=None, retries=3, backoff=0.5,
+                 max_backoff=30, retry_statuses=(429, 500, 502, 503, 504),
+                 retry_codes=(), throttle_statuses=(429, 503),
+                 breaker_threshold=5, breaker_timeout=30,
+                 max_concurrency=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = frozenset(retry_statuses)
+        self.retry_codes = frozenset(str(code) for code in retry_codes)
+        self.throttle_statuses = frozenset(throttle_statuses)
+        self._bucket = rate and _TokenBucket(rate, burst) or None
+        self._breaker = None
+        if breaker_threshold:
+            self._breaker = _CircuitBreaker(breaker_threshold,
+                                            breaker_timeout)
+        self._limiter = None
+        if max_concurrency:
+            self._limiter = _AdaptiveLimiter(max_concurrency)
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'attempts': 0, 'retries': 0,
+                       'failures': 0, 'throttled': 0, 'rejected': 0,
+                       'rate_waits': 0}
+
+    def _count(self, name):
+        self._lock.acquire()
+        self._stats[name] += 1
+        self._lock.release()
+
+    def _classify(self, error):
+        """Returns (transient, throttled, delay) for an exception, where
+        `delay` is the wait the server asked for, if any."""
+        if isinstance(error, urllib2.HTTPError):
+            delay = None
+            retry_after = error.hdrs and error.hdrs.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            return (error.code in self.retry_statuses,
+                    error.code in self.throttle_statuses, delay)
+        if isinstance(error, ServiceException):
+            return str(error.get_id()) in self.retry_codes, False, None
+        if isinstance(error, (urllib2.URLError, httplib.HTTPException,
+                              socket.error)):
+            return True, False, None
+        return False, False, None
+
+    def begin(self):
+        """Waits for the rate and concurrency limits before an attempt.
+        Raises CircuitOpenError if the circuit breaker rejects it."""
+        if self._breaker is not None and not self._breaker.allow():
+            self._count('rejected')
+            raise CircuitOpenError(
+                None, 'The service is failing, try again later')
+        if self._bucket is not None and self._bucket.acquire():
+            self._count('rate_waits')
+        if self._limiter is not None:
+            self._limiter.acquire()
+        self._count('attempts')
+
+    def end(self, error=None, completed=True):
+        """Reports the `error`, or None, an attempt started with `begin`
+        ended with, and returns its (transient, delay). An attempt that
+        didn't complete, like a stream closed early, or that ran out of
+        time only frees its place, and the trial call of a half-open
+        breaker is left to the next attempt:
+
+            >>> policy = _TransportPolicy(breaker_threshold=1,
+            ...                           breaker_timeout=0)
+            >>> policy.begin()
+            >>> policy.end(socket.error())
+            (True, None)
+            >>> policy.begin()
+            >>> policy.end(DeadlineExceeded(None, 'Deadline exceeded'))
+            (False, None)
+            >>> policy.begin()
+            >>> policy.end(completed=False)
+            (False, None)
+            >>> policy.begin()
+            >>> policy.end()
+            (False, None)
+            >>> policy.get_stats()['breaker']
+            'closed'
+        """
+        transient = throttled = False
+        delay = None
+        try:
+            if not completed or isinstance(error, DeadlineExceeded):
+                if self._breaker is not None:
+                    self._breaker.cancel()
+            elif error is None:
+                if self._breaker is not None:
+                    self._breaker.success()
+            else:
+                transient, throttled, delay = self._classify(error)
+                if not transient:
+                    # The service answered, it is healthy.
+                    if self._breaker is not None:
+                        self._breaker.success()
+                else:
+                    self._count('failures')
+                    if throttled:
+                        self._count('throttled')
+                    if self._breaker is not None:
+                        self._breaker.failure()
+        finally:
+            if self._limiter is not None:
+                self._limiter.release(throttled)
+        return transient, delay
+
+    def call(self, function, at=None):
+        """Returns the result of `function`, calling it again after
+        transient errors unless the deadline `at` comes first."""
+        self._count('calls')
+        attempt = 0
+        while True:
+            self.begin()
+            try:
+                result = function()
+            except Exception, e:
+                transient, delay = self.end(e)
+                if not transient or attempt >= self.retries:
+                    raise
+            except:
+                self.end(completed=False)
+                raise
+            else:
+                self.end()
+                return result
+            if delay is None:
+                # Exponential backoff with full jitter.
+                delay = random.uniform(0, min(
+                    self.max_backoff, self.backoff * 2 ** attempt))
+            if at is not None and time.time() + delay >= at:
+                raise e
+            attempt += 1
+            self._count('retries')
+            time.sleep(delay)
+
+    def get_stats(self):
+        """Returns a dict with the policy counters."""
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._lock.release()
+        if self._breaker is not None:
+            stats['breaker'] = self._breaker.state
+        if self._limiter is not None:
+            stats['concurrency'] = int(self._limiter.limit)
+        return stats
+
+
+class _Credential(object):
+    """An api key of the credential pool, with its own rate limit."""
+
+    def __init__(self, username, api_key, rate=None, burst=None,
+                 max_in_flight=None):
+        self.username = username
+        self.api_key = api_key
+        self.bucket = rate and _TokenBucket(rate, burst) or None
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.suspended_until = 0
+        self.stats = {'requests': 0, 'errors': 0, 'suspensions': 0,
+                      'rate_waits': 0}
+
+    def is_full(self):
+        return (self.max_in_flight is not None and
+                self.in_flight >= self.max_in_flight)
+
+
+class _CredentialPool(object):
+    """Spreads the requests over several api keys.
+
+    Every request goes to the key with the fewest requests in flight that
+    is under its rate and in-flight limits. A key answered with one of the
+    `suspend_statuses` or `suspend_codes` is left aside for `suspend`
+    seconds and the request is sent again with another key. When every
+    key is suspended, requests wait for the first to come back."""
+
+    def __init__(self, credentials, rate=None, burst=None,
+                 max_in_flight=None, suspend=60,
+                 suspend_statuses=(401, 403, 429), suspend_codes=()):
+        if not credentials:
+            raise ValueError('The credential pool needs at least one key')
+        self.credentials = [
+            _Credential(username, api_key, rate, burst, max_in_flight)
+            for username, api_key in credentials]
+        self.suspend = suspend
+        self.suspend_statuses = frozenset(suspend_statuses)
+        self.suspend_codes = frozenset(str(code) for code in suspend_codes)
+        self._lock = threading.Condition()
+
+    def acquire(self, at=None):
+        """Returns the credential to send a request with, waiting until
+        one is free. Raises DeadlineExceeded if none is by the time `at`."""
+        self._lock.acquire()
+        waited = False
+        try:
+            while True:
+                now = time.time()
+                available = [credential for credential in self.credentials
+                             if credential.suspended_until <= now]
+                # Every key is suspended, wait for the first to come back.
+                delay = None
+                if not available:
+                    delay = min(credential.suspended_until
+                                for credential in self.credentials) - now
+                available.sort(key=lambda c: (c.in_flight,
+                                              c.stats['requests']))
+                for credential in available:
+                    if credential.is_full():
+                        continue
+                    wait = credential.bucket and credential.bucket.take()
+                    if not wait:
+                        credential.in_flight += 1
+                        credential.stats['requests'] += 1
+                        if waited:
+                            credential.stats['rate_waits'] += 1
+                        return credential
+                    waited = True
+                    delay = min(delay or wait, wait)
+                if at is not None:
+                    remaining = at - time.time()
+                    if remaining <= 0:
+                        raise DeadlineExceeded(None, 'Deadline exceeded')
+                    delay = min(delay or remaining, remaining)
+                # Woken up early when a request in flight ends.
+                self._lock.wait(delay)
+        finally:
+            self._lock.release()
+
+    def release(self, credential, failed=False, suspend=False):
+        self._lock.acquire()
+        try:
+            credential.in_flight -= 1
+            if failed or suspend:
+                credential.stats['errors'] += 1
+            if suspend:
+                credential.stats['suspensions'] += 1
+                credential.suspended_until = time.time() + self.suspend
+            self._lock.notify_all()
+        finally:
+            self._lock.release()
+
+    def pick(self):
+        """Returns a credential without waiting or counting it in flight,
+        for requests that can't block."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            credential = min(self.credentials, key=lambda c: (
+                c.suspended_until > now, c.in_flight, c.stats['requests']))
+            credential.stats['requests'] += 1
+            return credential
+        finally:
+            self._lock.release()
+
+    def should_suspend(self, error=None, body=None):
+        """Returns True if an HTTPError, ServiceException or response body
+        tells the key is over its quota or not allowed."""
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in self.suspend_statuses
+        if isinstance(error, ServiceException):
+            return str(error.get_id()) in self.suspend_codes
+        if body is not None and self.suspend_codes:
+            return str(_response_error(body)) in self.suspend_codes
+        return False
+
+    def call(self, function, at=None):
+        """Returns `function(credential)`, calling it again with another
+        key while the keys used are suspended by the answers."""
+        for attempt in xrange(len(self.credentials)):
+            credential = self.acquire(at)
+            suspend = False
+            try:
+                result = function(credential)
+            except Exception, e:
+                suspend = self.should_suspend(e)
+                self.release(credential, True, suspend)
+                if not suspend or attempt == len(self.credentials) - 1:
+                    raise
+                continue
+            suspend = self.should_suspend(body=result[0])
+            self.release(credential, False, suspend)
+            if not suspend:
+                break
+        return result
+
+    def get_stats(self):
+        """Returns a dict with the counters of every key by username."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            stats = {}
+            for credential in self.credentials:
+                counters = dict(credential.stats)
+                counters['in_flight'] = credential.in_flight
+                counters['suspended'] = max(
+                    0, credential.suspended_until - now)
+                stats[credential.username] = counters
+            return stats
+        finally:
+            self._lock.release()
+
+
+# Upper bounds in seconds of the buckets of latency histograms.
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+            5, 10)
+
+
+class _Histogram(object):
+    """Counts of values by bucket, like a Prometheus histogram."""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Returns a dict with the cumulative count of every bucket."""
+        buckets = []
+        total = 0
+        for bound, count in zip(_BUCKETS + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class _Metrics(object):
+    """Counters and latency histograms of the requests of every method,
+    fed with the instrumentation events."""
+
+    # The counter every event increments, and which of its info values
+    # is added to which counter.
+    _counters = {
+        'request': ('requests', None, None),
+        'download': ('downloads', 'bytes', 'bytes_downloaded'),
+        'cache_set': ('cache_stores', 'bytes', 'bytes_cached'),
+        'parse': ('parses', 'bytes', 'bytes_parsed'),
+        'build': (None, None, None),
+        'revalidate': ('revalidations', None, None),
+        'error': ('errors', None, None),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, event, method, seconds, info):
+        self._lock.acquire()
+        try:
+            metrics = self._methods.get(method)
+            if metrics is None:
+                metrics = self._methods[method] = (
+                    dict.fromkeys(('requests', 'errors', 'downloads',
+                                   'bytes_downloaded', 'parses',
+                                   'bytes_parsed', 'cache_hits',
+                                   'cache_misses', 'memory_cache_hits',
+                                   'memory_cache_misses', 'cache_stores',
+                                   'bytes_cached', 'revalidations',
+                                   'not_modified'), 0), {}, {})
+            counters, errors, histograms = metrics
+            if event == 'cache_get':
+                prefix = info['level'] == 'memory' and 'memory_' or ''
+                outcome = info['hit'] and 'cache_hits' or 'cache_misses'
+                counters[prefix + outcome] += 1
+            else:
+                counter, field, total = self._counters[event]
+                if counter is not None:
+                    counters[counter] += 1
+                if field is not None:
+                    counters[total] += info[field]
+                if event == 'error':
+                    errors[info['error']] = errors.get(info['error'], 0) + 1
+                elif event == 'revalidate' and not info['modified']:
+                    counters['not_modified'] += 1
+            histogram = histograms.get(event)
+            if histogram is None:
+                histogram = histograms[event] = _Histogram()
+            histogram.observe(seconds)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns a dict of the metrics of every method."""
+        self._lock.acquire()
+        try:
+            snapshot = {}
+            for method, (counters, errors, histograms) in (
+                    self._methods.items()):
+                snapshot[method] = dict(counters)
+                snapshot[method]['errors_by_type'] = dict(errors)
+                snapshot[method]['seconds'] = dict(
+                    (event, histogram.snapshot())
+                    for event, histogram in histograms.items())
+            return snapshot
+        finally:
+            self._lock.release()
+
+
+class _Hedger(object):
+    """Sends a second request when the first one takes longer than the
+    `percentile` of the recent latencies of its method, and returns the
+    response that arrives first."""
+
+    def __init__(self, percentile=95, min_samples=20, window=1000):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def _record(self, method, latency):
+        self._lock.acquire()
+        try:
+            latencies = self._latencies.get(method)
+            if latencies is None:
+                latencies = self._latencies[method] = deque(
+                    maxlen=self.window)
+            latencies.append(latency)
+        finally:
+            self._lock.release()
+
+    def _threshold(self, method):
+        """Returns the latency after which to hedge, None if unknown."""
+        self._lock.acquire()
+        try:
+            latencies = sorted(self._latencies.get(method, ()))
+        finally:
+            self._lock.release()
+        if len(latencies) < self.min_samples:
+            return None
+        index = int(len(latencies) * self.percentile / 100.0)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _count(self, name):
+        self._lock.acquire()
+        self._stats[name] += 1
+        self._lock.release()
+
+    def run(self, method, function, at=None):
+        """Returns the first result of calling `function` once or twice,
+        or the first error if both calls fail."""
+        self._count('requests')
+        threshold = self._threshold(method)
+        outcomes = []
+        finished = threading.Condition()
+
+        def attempt(index):
+            start = time.time()
+            try:
+                outcome = (index, True, function())
+                self._record(method, time.time() - start)
+            except Exception, e:
+                outcome = (index, False, e)
+            finished.acquire()
+            outcomes.append(outcome)
+            finished.notify_all()
+            finished.release()
+
+        attempts = 1
+        if threshold is None or (at is not None and
+                                 time.time() + threshold >= at):
+            attempt(0)
+        else:
+            _spawn(attempt, 0)
+            finished.acquire()
+            try:
+                if not outcomes:
+                    finished.wait(threshold)
+                if not outcomes:
+                    self._count('hedged')
+                    _spawn(attempt, 1)
+                    attempts = 2
+            finally:
+                finished.release()
+        finished.acquire()
+        try:
+            while True:
+                for index, succeeded, value in outcomes:
+                    if succeeded:
+                        if index:
+                            self._count('hedge_wins')
+                        return value
+                if len(outcomes) == attempts:
+                    raise outcomes[0][2]
+                finished.wait()
+        finally:
+            finished.release()
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
+
+
+def _spawn(function, *args):
+    """Runs a function on a new daemon thread."""
+    thread = threading.Thread(target=function, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
 
 
 class _Request(object):
@@ -69,12 +1801,21 @@ class _Request(object):
         self.params['user'] = username
         self.params['api'] = api_key
         self.method = method_name
-
-    def _download_response(self):
-        """Returns a response body string from the server"""
+        # How the proxy, if any, may cache the response.
+        self.cache_control = 'no-store'
+        # True to go to the web service even if there is a proxy.
+        self.direct = False
+
+    def _get_location(self, credential=None):
+        """Returns the (host, path, headers) to send the request to, signed
+        with the `credential` of the pool if given."""
+        params = self.params
+        if credential is not None:
+            params = dict(params, user=credential.username,
+                          api=credential.api_key)
         data = []
-        for name in self.params.keys():
-            value = self.params[name]
+        for name in params.keys():
+            value = params[name]
             if isinstance(value, unicode):
                 value = value.encode('utf8')
             data.append('='.join((name, urllib.quote_plus(str(value)))))
@@ -83,79 +1824,635 @@ class _Request(object):
         headers = {
             'Content-type': 'application/x-www-form-urlencoded',
             'Accept-Charset': 'utf-8',
+            'Accept-Encoding': 'gzip, deflate',
             'User-Agent': __name__ + '/' + __version__
         }
-        request = urllib2.Request(
-            'http://' + WS_SERVER + self.method + '?' + data, None, headers)
-        response = urllib2.urlopen(request).read()
-        self._check_response_for_errors(response)
-        return response
-
-    def execute(self, cacheable=False):
-        """Returns the XML DOM response from the server"""
-        if is_caching_enabled() and cacheable:
-            response = self._get_cached_response()
+        proxy = _get_proxy()
+        if proxy is not None and not self.direct:
+            headers['Cache-Control'] = self.cache_control
+            return proxy, '/' + self.method + '?' + data, headers
+        host, base = _split_server(WS_SERVER)
+        return host, base + self.method + '?' + data, headers
+
+    def _download_response(self, at=None, validators=None):
+        """Returns the (body, validators) of the response of the server,
+        raising DeadlineExceeded if it isn't read by the time `at`.
+
+        With the `validators` of a cached response, the request is
+        conditional and the body is None if the response didn't change."""
+        hedger = _get_hedger()
+        if hedger is not None:
+            return hedger.run(
+                self.method, lambda: self._download(at, validators), at)
+        return self._download(at, validators)
+
+    def _download(self, at, validators):
+        pool = _get_credential_pool()
+        if pool is None:
+            return self._download_with(at, validators)
+        return pool.call(
+            lambda credential: self._download_with(at, validators,
+                                                   credential), at)
+
+    def _download_with(self, at, validators, credential=None):
+        host, path, headers = self._get_location(credential)
+        _add_validators(headers, validators)
+        start = time.time()
+        size = 0
+        try:
+            response = _get_connection_pool().urlopen(
+                host, path, headers, _remaining(at))
+            try:
+                decoder = _decoder(response.msg)
+                chunks = []
+                while True:
+                    if at is not None:
+                        response.set_timeout(_remaining(at))
+                    chunk = response.read(65536)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if decoder is not None:
+                        chunk = decoder.decompress(chunk)
+                    chunks.append(chunk)
+                if decoder is not None:
+                    chunks.append(decoder.flush())
+                body = ''.join(chunks)
+            finally:
+                response.close()
+        except socket.timeout:
+            # Timeouts are only set to make the deadline.
+            _count_request('timeouts')
+            raise DeadlineExceeded(None, 'Deadline exceeded')
+        _emit('download', self.method, time.time() - start,
+              {'bytes': size, 'status': response.status})
+        if response.status == 304 and validators:
+            return None, validators
+        _check_status(host, path, response.status, response.reason,
+                      response.msg, body)
+        return body, _validators(response.msg)
+
+    def _fetch_response(self, at=None, validators=None):
+        """Returns the (body, validators) of the response of the server,
+        sharing the download with the other threads asking for the same
+        request at once."""
+        key = self._get_flight_key()
+        if validators:
+            key += ' conditional'
+        if self.direct:
+            # Not to wait for a request of this process sent to the proxy.
+            key += ' direct'
+        return _single_flight.do(
+            key, lambda: self._download_response(at, validators),
+            _remaining(at))
+
+    def execute(self, cacheable=False, handler=None, ttl=None):
+        """Returns the response parsed by `handler`.
+
+        The handler gets a file object with the response body. By default
+        the root element of the response is returned. Cached responses
+        expire after `ttl` seconds, if given."""
+        if handler is None:
+            handler = _parse
+        self.cache_control = _cache_control(cacheable, ttl)
+        start = time.time()
+        try:
+            result = self._execute(cacheable, handler, ttl)
+        except Exception, e:
+            _emit('error', self.method, time.time() - start,
+                  {'error': e.__class__.__name__})
+            raise
+        _emit('request', self.method, time.time() - start)
+        return result
+
+    def _execute(self, cacheable, handler, ttl):
+        cacheable = is_caching_enabled() and cacheable
+        stale = None
+        if cacheable:
+            response, validators, fresh = self._get_cached_entry()
+            if fresh:
+                return self._parse_response(handler, response)
+            if validators:
+                stale = response, validators
+        at = _get_deadline()
+        policy = _get_transport_policy()
+        if policy is None:
+            return self._fetch_parsed(cacheable, handler, ttl, at, stale)
+        return policy.call(
+            lambda: self._fetch_parsed(cacheable, handler, ttl, at, stale),
+            at)
+
+    def _parse_response(self, handler, response):
+        """Returns the response body parsed by `handler`."""
+        start = time.time()
+        result = handler(StringIO(response))
+        _emit('parse', self.method, time.time() - start,
+              {'bytes': len(response)})
+        return result
+
+    def _fetch_parsed(self, cacheable, handler, ttl, at=None, stale=None):
+        """Downloads the response and returns it parsed by `handler`.
+
+        A `stale` (body, validators) cached response is revalidated, and
+        used again if the server answers it didn't change."""
+        response, validators = self._fetch_response(at, stale and stale[1])
+        if response is None:
+            response = stale[0]
+            _emit('revalidate', self.method, 0, {'modified': False})
+        elif stale is not None:
+            _emit('revalidate', self.method, 0, {'modified': True})
+        result = self._parse_response(handler, response)
+        _remaining(at)
+        # Only responses that parsed without errors end up in the cache.
+        if cacheable:
+            self._cache_response(response, ttl, validators)
+        return result
+
+    def iter_elements(self, tag, cacheable=False, ttl=None):
+        """Yields every `tag` element of the response as soon as it is
+        parsed, while the rest of the response is still being read.
+
+        Elements are dropped once the next one is asked for, so memory
+        doesn't grow with the length of the response, unless it has to be
+        kept whole to be cached. Streamed requests are not retried, hedged
+        or coalesced. Stale cached responses are revalidated as by
+        execute."""
+        self.cache_control = _cache_control(cacheable, ttl)
+        cacheable = is_caching_enabled() and cacheable
+        start = time.time()
+        stale = None
+        if cacheable:
+            response, validators, fresh = self._get_cached_entry()
+            if fresh:
+                for node in _iterparse(StringIO(response), tag):
+                    yield node
+                _emit('request', self.method, time.time() - start)
+                return
+            if validators:
+                stale = response, validators
+        at = _get_deadline()
+        # Streams are not retried, but are rate limited and checked by
+        # the circuit breaker like any request.
+        policy = _get_transport_policy()
+        if policy is not None:
+            policy._count('calls')
+            policy.begin()
+        ended = failed = suspend = False
+        pool = _get_credential_pool()
+        credential = None
+        try:
+            try:
+                credential = pool and pool.acquire(at)
+                host, path, headers = self._get_location(credential)
+                _add_validators(headers, stale and stale[1])
+                response = _get_connection_pool().urlopen(
+                    host, path, headers, _remaining(at))
+                try:
+                    reader = _StreamReader(
+                        response, _decoder(response.msg), at, cacheable)
+                    source = reader
+                    if response.status == 304 and stale is not None:
+                        reader.read()
+                        source = StringIO(stale[0])
+                    elif response.status != 200:
+                        _check_status(host, path, response.status,
+                                      response.reason, response.msg,
+                                      reader.read())
+                    for node in _iterparse(source, tag):
+                        yield node
+                finally:
+                    response.close()
+            except socket.timeout:
+                _count_request('timeouts')
+                raise DeadlineExceeded(None, 'Deadline exceeded')
+        except Exception, e:
+            failed = True
+            suspend = pool is not None and pool.should_suspend(e)
+            if policy is not None:
+                ended = True
+                policy.end(e)
+            _emit('error', self.method, time.time() - start,
+                  {'error': e.__class__.__name__})
+            raise
         else:
-            response = self._download_response()
-        return minidom.parseString(response)
+            if policy is not None:
+                ended = True
+                policy.end()
+        finally:
+            if credential is not None:
+                pool.release(credential, failed, suspend)
+            if policy is not None and not ended:
+                policy.end(completed=False)
+        _emit('download', self.method, time.time() - start,
+              {'bytes': reader.size, 'status': response.status})
+        if stale is not None:
+            _emit('revalidate', self.method, 0,
+                  {'modified': source is reader})
+        if source is not reader:
+            self._cache_response(stale[0], ttl, stale[1])
+        elif cacheable:
+            self._cache_response(''.join(reader.chunks), ttl,
+                                 _validators(response.msg))
+        _emit('request', self.method, time.time() - start)
 
     def _get_cache_key(self):
-        """Cache key"""
-        keys = list(self.params.keys())
+        """Cache key, the same whatever credentials sign the request and
+        whether the params are unicode or UTF-8:
+
+            >>> params = {'artist': 'Bj\\xc3\\xb6rk', 'track': u'J\\xf3ga'}
+            >>> key = _Request('track/topchannels', params, 'a', 'A')
+            >>> params = {'artist': u'Bj\\xf6rk', 'track': 'J\\xc3\\xb3ga'}
+            >>> other = _Request('track/topchannels', params, 'b', 'B')
+            >>> key._get_cache_key() == other._get_cache_key()
+            True
+        """
+        keys = [key for key in self.params.keys()
+                if key not in ('user', 'api')]
         keys.sort()
-        cache_key = str()
+        cache_key = self.method
         for key in keys:
-            cache_key += key + str(self.params[key])
+            value = self.params[key]
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            cache_key += '%s%s' % (key, value)
         return get_md5(cache_key)
 
-    def _is_cached(self):
-        """Returns True if the request is available in the cache."""
-        return os.path.exists(
-                os.path.join(_get_cache_dir(), self._get_cache_key()))
+    def _get_flight_key(self):
+        """Key of the identical requests sent at once, which share one
+        download. Unless a credential pool signs them all, requests with
+        other credentials are not shared, as their answers may differ,
+        like the errors of an invalid key or an exhausted quota."""
+        key = self._get_cache_key()
+        if _get_credential_pool() is None:
+            key += ' ' + get_md5('%s\n%s' % (
+                _utf8(self.params.get('user')), _utf8(self.params.get('api'))))
+        return key
+
+    def _get_cached_entry(self):
+        """Returns the (body, validators, fresh) of the cached response.
+
+        Responses cached with validators are kept after they expire, to be
+        revalidated, so their body may be stale. The body is None if the
+        response is not cached."""
+        start = time.time()
+        value = _get_cache_backend().get(self._get_cache_key())
+        response, validators, fresh = value, None, value is not None
+        if value is not None and value.startswith(_VALIDATED):
+            meta, _, response = value.partition('\n')
+            meta = json.loads(meta[len(_VALIDATED):])
+            validators = meta['validators']
+            fresh = meta['expires'] > time.time()
+        _emit('cache_get', self.method, time.time() - start,
+              {'hit': fresh, 'level': 'backend'})
+        return response, validators, fresh
 
     def _get_cached_response(self):
-        """Returns a file object of the cached response."""
-        if not self._is_cached():
-            response = self._download_response()
-            response_file = open(
-                os.path.join(_get_cache_dir(), self._get_cache_key()), "w")
-            response_file.write(response)
-            response_file.close()
-        return open(
-            os.path.join(_get_cache_dir(), self._get_cache_key()), "r").read()
-
-    def _check_response_for_errors(self, response):
-        """Checks the response for errors and raises one if any exists."""
-        doc = minidom.parseString(response)
-        e = doc.getElementsByTagName('response')[0]
-        if e.getAttribute('status') != "ok":
-            e = doc.getElementsByTagName('error')[0]
-            status = e.getAttribute('code')
-            details = e.firstChild.data.strip()
-            raise ServiceException(status, details)
+        """Returns the cached response body or None if not cached."""
+        response, validators, fresh = self._get_cached_entry()
+        if fresh:
+            return response
+        return None
+
+    def _cache_response(self, response, ttl=None, validators=None):
+        """Saves a response body in the cache. Responses with `validators`
+        that expire stay in the cache to be revalidated."""
+        start = time.time()
+        if validators and ttl is not None:
+            meta = json.dumps({'expires': time.time() + ttl,
+                               'validators': validators})
+            response, ttl = _VALIDATED + meta + '\n' + response, None
+        _get_cache_backend().set(self._get_cache_key(), response, ttl)
+        _emit('cache_set', self.method, time.time() - start,
+              {'bytes': len(response)})
+
+
+# Prefix of the cached responses stored with their validators.
+_VALIDATED = 'pycast-validated '
+
+
+class _Decoder(object):
+    """Decompresses a gzip or deflate response body as it is read."""
+
+    def __init__(self):
+        # Detects gzip and zlib headers.
+        self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self._started = False
+
+    def decompress(self, data):
+        if not self._started and data:
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                # Some servers send deflate bodies without a zlib header.
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class _StreamReader(object):
+    """A file object reading a response body as it arrives, decompressing
+    it and keeping a copy of it if asked to."""
+
+    def __init__(self, response, decoder=None, at=None, keep=False):
+        self._response = response
+        self._decoder = decoder
+        self._at = at
+        self.chunks = None
+        if keep:
+            self.chunks = []
+        self.size = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(lambda: self.read(65536), ''))
+        while True:
+            if self._at is not None:
+                self._response.set_timeout(_remaining(self._at))
+            data = self._response.read(size)
+            self.size += len(data)
+            if self._decoder is not None:
+                if data:
+                    data = self._decoder.decompress(data)
+                    if not data:
+                        # Not enough compressed data for any output yet.
+                        continue
+                else:
+                    data = self._decoder.flush()
+                    self._decoder = None
+            if self.chunks is not None:
+                self.chunks.append(data)
+            return data
+
+
+def _add_validators(headers, validators):
+    """Makes a request conditional on the `validators` of a cached
+    response, if any."""
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+
+def _decoder(headers):
+    """Returns a _Decoder for a compressed response, None otherwise."""
+    encoding = (headers.get('content-encoding') or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return _Decoder()
+    return None
+
+
+def _validators(headers):
+    """Returns the ETag and Last-Modified of a response, None if it has
+    neither."""
+    etag = headers.get('etag')
+    last_modified = headers.get('last-modified')
+    if not etag and not last_modified:
+        return None
+    return {'etag': etag, 'last_modified': last_modified}
+
+
+class Session(object):
+    """Credentials shared by many objects.
+
+    Objects created with the same username and api key share one session,
+    and every request goes through the shared connection pool. With
+    `intern`, the Artist, Channel, Label and Track objects built by the
+    session are kept in an identity map, so equal entities are the same
+    object:
+
+        session = pycast.Session('YOUR_USER_HERE', 'YOUR_KEY_HERE', True)
+        madonna = session.artist('Madonna')
+        assert madonna is session.artist('Madonna')
+    """
+
+    __slots__ = ('username', 'api_key', 'intern', '_lock', '_identities',
+                 '__weakref__')
+
+    def __init__(self, username, api_key, intern=False):
+        self.username = username
+        self.api_key = api_key
+        self.intern = intern
+        self._lock = threading.Lock()
+        self._identities = weakref.WeakValueDictionary()
+
+    def __repr__(self):
+        return "pycast.Session(%r)" % self.username
+
+    def __reduce__(self):
+        return Session, (self.username, self.api_key, self.intern)
+
+    def _get(self, key, create):
+        """Returns the interned object for key, creating it if needed."""
+        if not self.intern:
+            return create()
+        self._lock.acquire()
+        try:
+            entity = self._identities.get(key)
+            if entity is None:
+                entity = self._identities[key] = create()
+            return entity
+        finally:
+            self._lock.release()
+
+    def artist(self, name):
+        """Returns the Artist with the given name"""
+        return self._get((Artist, name), lambda: Artist(name, self))
+
+    def track(self, artist, title):
+        """Returns the Track with the given artist name and title"""
+        if not isinstance(artist, Artist):
+            artist = self.artist(artist)
+        return self._get((Track, artist.get_name(), title),
+                         lambda: Track(artist, title, self))
+
+    def channel(self, keyname):
+        """Returns the Channel with the given keyname"""
+        return self._get((Channel, keyname), lambda: Channel(keyname, self))
+
+    def label(self, name):
+        """Returns the Label with the given name"""
+        return self._get((Label, name), lambda: Label(name, self))
 
 
 class _BaseObject(object):
     """An abstract webservices object."""
 
-    def __init__(self, username, api_key):
-        self.username = username
-        self.api_key = api_key
+    __slots__ = ('session', '_async', '__weakref__')
 
-    def _request(self, method_name, cacheable=False, params=None):
+    def __init__(self, username, api_key=None):
+        """`username` may also be a Session, then api_key is not needed."""
+        if isinstance(username, Session):
+            self.session = username
+        else:
+            self.session = _get_session(username, api_key)
+        self._async = None
+
+    def __getstate__(self):
+        # Pickled objects are not wrapped by the AsyncClient they were.
+        state = _slots_state(self)
+        state.pop('_async', None)
+        return state
+
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+        self._async = None
+
+    @property
+    def username(self):
+        return self.session.username
+
+    @username.setter
+    def username(self, username):
+        # The object moves to the session of its new credentials.
+        self.session = _get_session(username, self.api_key)
+
+    @property
+    def api_key(self):
+        return self.session.api_key
+
+    @api_key.setter
+    def api_key(self, api_key):
+        self.session = _get_session(self.username, api_key)
+
+    def _request(self, method_name, cacheable=False, params=None, tag=None,
+                 build=None, columnar=False):
+        """Sends a request and returns the root element of the response.
+
+        If a `tag` is given, returns instead the list of the results of
+        calling `build` with each `tag` element, as they are parsed.
+        Otherwise `build` gets the root element and its result is returned.
+        With `columnar`, the `tag` elements are stored in a TopList.
+        Objects wrapped by an AsyncClient return a Deferred instead.
+
+        `cacheable` is True to cache the response for ever, False not to
+        cache it, a number of seconds to cache it for, or None to decide
+        from the time window of the query."""
         if not params:
             params = self._get_params()
+        cacheable, ttl = _cache_policy(cacheable, params)
         req = _Request(method_name, params, self.username, self.api_key)
-        return req.execute(cacheable)
+        if tag is not None and columnar:
+            parse = lambda source: TopList._parse(
+                tag, _iterparse(source, tag), self.session)
+            finish = TopList.copy
+        elif tag is not None:
+            parse = lambda source: map(build, _iterparse(source, tag))
+            # Cached lists are copied so callers can't change them.
+            finish = list
+        else:
+            parse = _parse
+            finish = build or (lambda doc: doc)
+        memory = cacheable and _get_memory_cache()
+        if memory:
+            # Parsed values hold entities of this session, so sessions
+            # don't share them even though they share responses.
+            key = (req._get_cache_key(), tag, columnar, self.session)
+            start = time.time()
+            value = memory.get(key)
+            _emit('cache_get', method_name, time.time() - start,
+                  {'hit': value is not None, 'level': 'memory'})
+            if value is not None:
+                _emit('request', method_name, time.time() - start)
+                if self._async is not None:
+                    return _done_deferred(finish(value))
+                return finish(value)
+
+        def handler(source):
+            value = parse(source)
+            if memory:
+                memory.set(key, value, len(source.getvalue()), ttl)
+            start = time.time()
+            result = finish(value)
+            _emit('build', method_name, time.time() - start)
+            return result
+
+        if self._async is not None:
+            return self._async._submit(req, cacheable, handler, ttl)
+        return req.execute(cacheable, handler, ttl)
+
+    def _iter_request(self, method_name, cacheable=False, params=None,
+                      tag=None, build=None):
+        """Yields `build` of every `tag` element of the response as soon as
+        it is parsed, reading the response as it arrives."""
+        if not params:
+            params = self._get_params()
+        cacheable, ttl = _cache_policy(cacheable, params)
+        req = _Request(method_name, params, self.username, self.api_key)
+        for node in req.iter_elements(tag, cacheable, ttl):
+            yield build(node)
+
+    def _top_artist(self, node):
+        return TopItem(self.session.artist(_extract(node, 'name')),
+                       _extract(node, 'playcount'))
+
+    def _top_track(self, node):
+        title = _extract(node, 'name')
+        artist = _extract(node, 'name', 1)
+        return TopItem(self.session.track(artist, title),
+                       _extract(node, 'playcount'))
+
+    def _top_channel(self, node):
+        return TopItem(self.session.channel(_extract(node, 'keyname')),
+                       _extract(node, 'playcount'))
+
+    def _top_label(self, node):
+        return TopItem(self.session.label(_extract(node, 'name')),
+                       _extract(node, 'playcount'))
+
+    def _match(self, node):
+        return Match(_extract(node, 'id'), self.session,
+                     fields=_match_fields(node, False))
 
     def _get_params(self):
         return dict()
 
+    def _get_playcount(self, method, period, todate, cache):
+        items = getattr(self, method)(period, todate, cache, columnar=True)
+        if isinstance(items, Deferred):
+            # Entities wrapped by an AsyncClient list their items later.
+            items = items.result()
+        return int(sum(items.get_weights()))
+
+    def _get_playcount_series(self, method, start, end, period, max_workers,
+                              cache):
+        """Returns the dates and playcounts of every period of a range,
+        adding up the weights that `method` lists for each of them."""
+        todates = _period_ends(start, end, period)
+        store = _get_series_store()
+        source = u'%s\t%s' % (_entity_source(self), method)
+        counts = store.get(source, period, todates)
+        missing = [todate for todate in todates if todate not in counts]
+        if missing:
+            fetch = lambda todate: self._get_playcount(
+                method, period, todate, cache)
+            pool = ThreadPool(min(max_workers, len(missing)))
+            try:
+                fetched = dict(zip(missing, pool.map(fetch, missing)))
+            finally:
+                pool.close()
+            counts.update(fetched)
+            # Periods that include today may still change.
+            today = datetime.datetime.utcnow().date()
+            store.set(source, period, dict(
+                (todate, count) for todate, count in fetched.items()
+                if todate < today))
+        values = [counts[todate] for todate in todates]
+        if numpy is None:
+            return todates, _int64_array(values)
+        return (numpy.array(todates, dtype='datetime64[D]'),
+                _int64_array(values))
+
 
 class Artist(_BaseObject):
     """ A Vericast artist """
 
-    def __init__(self, name, username, api_key):
+    __slots__ = ('name',)
+
+    def __init__(self, name, username, api_key=None):
         """Create an artist object.
         #Parametres:
           * name str: The artist's name.
@@ -173,7 +2470,8 @@ class Artist(_BaseObject):
         """Returns the name of the artist."""
         return self.name
 
-    def get_top_tracks(self, period=None, todate=None):
+    def get_top_tracks(self, period=None, todate=None, cache=None,
+                       columnar=False):
         """Returns a list of the top tracks for a given period"""
 
         params = self._get_params()
@@ -181,18 +2479,23 @@ class Artist(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('artist/toptracks', False, params)
-        tracks = []
-        for track in doc.getElementsByTagName('track'):
-            title = _extract(track, 'name')
-            artist = _extract(track, 'name', 1)
-            playcount = _number(_extract(track, 'playcount'))
-            tracks.append(TopItem(
-                Track(artist, title, self.username, self.api_key),
-                playcount))
-        return tracks
-
-    def get_top_channels(self, period=None, todate=None):
+        return self._request(
+            'artist/toptracks', cache, params, 'track', self._top_track,
+            columnar)
+
+    def iter_top_tracks(self, period=None, todate=None, cache=None):
+        """Yields the top tracks for a given period as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'artist/toptracks', cache, params, 'track', self._top_track)
+
+    def get_top_channels(self, period=None, todate=None, cache=None,
+                         columnar=False):
         """Returns a list of the top channels for a given period"""
 
         params = self._get_params()
@@ -200,17 +2503,32 @@ class Artist(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('artist/topchannels', False, params)
-        channels = []
-        for track in doc.getElementsByTagName('channel'):
-            keyname = _extract(track, 'keyname')
-            playcount = _number(_extract(track, 'playcount'))
-            channels.append(TopItem(
-                Channel(keyname, self.username, self.api_key),
-                playcount))
-        return channels
-
-    def get_matches(self, period=None, todate=None, page=1, limit=50):
+        return self._request(
+            'artist/topchannels', cache, params, 'channel', self._top_channel,
+            columnar)
+
+    def iter_top_channels(self, period=None, todate=None, cache=None):
+        """Yields the top channels for a given period as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'artist/topchannels', cache, params, 'channel', self._top_channel)
+
+    def get_playcount_series(self, start, end, period=DAY, max_workers=8,
+                             cache=None):
+        """Returns the dates and playcounts of the artist for every day, week
+        or month from `start` to `end`, as NumPy arrays if NumPy is
+        installed. Periods that already closed are kept in the series
+        store, so only new ones are requested."""
+        return self._get_playcount_series(
+            'get_top_channels', start, end, period, max_workers, cache)
+
+    def get_matches(self, period=None, todate=None, page=1, limit=50,
+                    cache=None):
         """Returns a list of matches order by date for a given period"""
 
         params = self._get_params()
@@ -220,24 +2538,30 @@ class Artist(_BaseObject):
             params['end'] = _date(todate)
         params['page'] = _number(page)
         params['limit'] = _number(limit)
-        doc = self._request('artist/matches', False, params)
-        matches = []
-        for match in doc.getElementsByTagName('match'):
-            id = _extract(match, 'id')
-            matches.append(Match(id, self.username, self.api_key))
-        return matches
+        return self._request(
+            'artist/matches', cache, params, 'match', self._match)
+
+    def iter_matches(self, period=None, todate=None, limit=50, prefetch=2,
+                     cache=None):
+        """Yields the matches of every page for a given period, fetching
+        the next `prefetch` pages in the background"""
+        return _iter_pages(
+            lambda page: self.get_matches(period, todate, page, limit, cache),
+            limit, prefetch)
 
 
 class Track(_BaseObject):
     """A Vericast track"""
 
-    def __init__(self, artist, title, username, api_key, **kwargs):
+    __slots__ = ('artist', 'title')
+
+    def __init__(self, artist, title, username, api_key=None, **kwargs):
         _BaseObject.__init__(self, username, api_key, **kwargs)
 
         if isinstance(artist, Artist):
             self.artist = artist
         else:
-            self.artist = Artist(artist, username, api_key)
+            self.artist = self.session.artist(artist)
         self.title = title
 
     def __repr__(self):
@@ -255,7 +2579,8 @@ class Track(_BaseObject):
         """Returns the track title."""
         return self.title
 
-    def get_top_channels(self, period=None, todate=None):
+    def get_top_channels(self, period=None, todate=None, cache=None,
+                         columnar=False):
         """Returns a list of the top channels for a given period"""
 
         params = self._get_params()
@@ -263,16 +2588,32 @@ class Track(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('track/topchannels', False, params)
-        channels = []
-        for track in doc.getElementsByTagName('channel'):
-            keyname = _extract(track, 'keyname')
-            playcount = _number(_extract(track, 'playcount'))
-            channels.append(TopItem(
-                Channel(keyname, self.username, self.api_key), playcount))
-        return channels
-
-    def get_matches(self, period=None, todate=None, page=1, limit=50):
+        return self._request(
+            'track/topchannels', cache, params, 'channel', self._top_channel,
+            columnar)
+
+    def iter_top_channels(self, period=None, todate=None, cache=None):
+        """Yields the top channels for a given period as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'track/topchannels', cache, params, 'channel', self._top_channel)
+
+    def get_playcount_series(self, start, end, period=DAY, max_workers=8,
+                             cache=None):
+        """Returns the dates and playcounts of the track for every day, week
+        or month from `start` to `end`, as NumPy arrays if NumPy is
+        installed. Periods that already closed are kept in the series
+        store, so only new ones are requested."""
+        return self._get_playcount_series(
+            'get_top_channels', start, end, period, max_workers, cache)
+
+    def get_matches(self, period=None, todate=None, page=1, limit=50,
+                    cache=None):
         """Returns a list of matches order by date"""
 
         params = self._get_params()
@@ -282,18 +2623,24 @@ class Track(_BaseObject):
             params['end'] = _date(todate)
         params['page'] = _number(page)
         params['limit'] = _number(limit)
-        doc = self._request('track/matches', False, params)
-        matches = []
-        for match in doc.getElementsByTagName('match'):
-            id = _extract(match, 'id')
-            matches.append(Match(id, self.username, self.api_key))
-        return matches
+        return self._request(
+            'track/matches', cache, params, 'match', self._match)
+
+    def iter_matches(self, period=None, todate=None, limit=50, prefetch=2,
+                     cache=None):
+        """Yields the matches of every page for a given period, fetching
+        the next `prefetch` pages in the background"""
+        return _iter_pages(
+            lambda page: self.get_matches(period, todate, page, limit, cache),
+            limit, prefetch)
 
 
 class Channel(_BaseObject):
     """A Vericat channel"""
 
-    def __init__(self, keyname, username, api_key):
+    __slots__ = ('keyname',)
+
+    def __init__(self, keyname, username, api_key=None):
         _BaseObject.__init__(self, username, api_key)
         self.keyname = keyname
 
@@ -306,22 +2653,31 @@ class Channel(_BaseObject):
     def get_keyname(self):
         return self.keyname
 
+    def _get_info(self, field):
+        """Returns a field of the channel info, from the channel catalog
+        if there is one that knows the channel."""
+        catalog = _get_channel_catalog()
+        if catalog is not None:
+            info = catalog.get(self.keyname)
+            if info is not None:
+                return info[field]
+        return self._request(
+            'channel/info', True, build=lambda doc: _extract(doc, field))
+
     def get_name(self):
         """Returns the channel name"""
-        doc = self._request('channel/info', True)
-        return _extract(doc, 'name')
+        return self._get_info('name')
 
     def get_website(self):
         """Returns the website of channel"""
-        doc = self._request('channel/info', True)
-        return _extract(doc, 'website')
+        return self._get_info('website')
 
     def get_media(self):
         """Returns a channel media (Radio FM, Radio AM or TV)"""
-        doc = self._request('channel/info', True)
-        return _extract(doc, 'media')
+        return self._get_info('media')
 
-    def get_top_artists(self, period=None, todate=None):
+    def get_top_artists(self, period=None, todate=None, cache=None,
+                        columnar=False):
         """Returns a list of the top artists for a given period"""
 
         params = self._get_params()
@@ -329,16 +2685,23 @@ class Channel(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('channel/topartists', False, params)
-        artists = []
-        for artist in doc.getElementsByTagName('artist'):
-            name = _extract(artist, 'name')
-            playcount = _extract(artist, 'playcount')
-            artists.append(TopItem(
-                Artist(name, self.username, self.api_key), playcount))
-        return artists
-
-    def get_top_tracks(self, period=None, todate=None):
+        return self._request(
+            'channel/topartists', cache, params, 'artist', self._top_artist,
+            columnar)
+
+    def iter_top_artists(self, period=None, todate=None, cache=None):
+        """Yields the top artists for a given period as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'channel/topartists', cache, params, 'artist', self._top_artist)
+
+    def get_top_tracks(self, period=None, todate=None, cache=None,
+                       columnar=False):
         """Returns a list of the top tracks for a given period"""
 
         params = self._get_params()
@@ -346,18 +2709,23 @@ class Channel(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('channel/toptracks', False, params)
-        tracks = []
-        for track in doc.getElementsByTagName('track'):
-            title = _extract(track, 'name')
-            artist = _extract(track, 'name', 1)
-            playcount = _number(_extract(track, 'playcount'))
-            tracks.append(TopItem(
-                Track(artist, title, self.username, self.api_key),
-                playcount))
-        return tracks
-
-    def get_top_labels(self, period=None, todate=None):
+        return self._request(
+            'channel/toptracks', cache, params, 'track', self._top_track,
+            columnar)
+
+    def iter_top_tracks(self, period=None, todate=None, cache=None):
+        """Yields the top tracks for a given period as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'channel/toptracks', cache, params, 'track', self._top_track)
+
+    def get_top_labels(self, period=None, todate=None, cache=None,
+                       columnar=False):
         """Returns a list of the top labels"""
 
         params = self._get_params()
@@ -365,16 +2733,32 @@ class Channel(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('channel/toplabels', False, params)
-        labels = []
-        for label in doc.getElementsByTagName('label'):
-            name = _extract(label, 'name')
-            playcount = _extract(label, 'playcount')
-            labels.append(TopItem(
-                Label(name, self.username, self.api_key), playcount))
-        return labels
-
-    def get_matches(self, period=None, todate=None, page=1, limit=50):
+        return self._request(
+            'channel/toplabels', cache, params, 'label', self._top_label,
+            columnar)
+
+    def iter_top_labels(self, period=None, todate=None, cache=None):
+        """Yields the top labels as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'channel/toplabels', cache, params, 'label', self._top_label)
+
+    def get_playcount_series(self, start, end, period=DAY, max_workers=8,
+                             cache=None):
+        """Returns the dates and playcounts of the channel for every day, week
+        or month from `start` to `end`, as NumPy arrays if NumPy is
+        installed. Periods that already closed are kept in the series
+        store, so only new ones are requested."""
+        return self._get_playcount_series(
+            'get_top_artists', start, end, period, max_workers, cache)
+
+    def get_matches(self, period=None, todate=None, page=1, limit=50,
+                    cache=None):
         """Returns a list of matches order by date for a given period"""
 
         params = self._get_params()
@@ -384,18 +2768,24 @@ class Channel(_BaseObject):
             params['end'] = _date(todate)
         params['page'] = _number(page)
         params['limit'] = _number(limit)
-        doc = self._request('channel/matches', False, params)
-        matches = []
-        for match in doc.getElementsByTagName('match'):
-            id = _extract(match, 'id')
-            matches.append(Match(id, self.username, self.api_key))
-        return matches
+        return self._request(
+            'channel/matches', cache, params, 'match', self._match)
+
+    def iter_matches(self, period=None, todate=None, limit=50, prefetch=2,
+                     cache=None):
+        """Yields the matches of every page for a given period, fetching
+        the next `prefetch` pages in the background"""
+        return _iter_pages(
+            lambda page: self.get_matches(period, todate, page, limit, cache),
+            limit, prefetch)
 
 
 class Label(_BaseObject):
     """A Vericast label"""
 
-    def __init__(self, name, username, api_key):
+    __slots__ = ('name',)
+
+    def __init__(self, name, username, api_key=None):
         _BaseObject.__init__(self, username, api_key)
         self.name = name
 
@@ -408,7 +2798,8 @@ class Label(_BaseObject):
     def get_name(self):
         return self.name
 
-    def get_top_artists(self, period=None, todate=None):
+    def get_top_artists(self, period=None, todate=None, cache=None,
+                        columnar=False):
         """Returns a list of the top artists"""
 
         params = self._get_params()
@@ -416,16 +2807,23 @@ class Label(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('label/topartists', False, params)
-        artists = []
-        for artist in doc.getElementsByTagName('artist'):
-            name = _extract(artist, 'name')
-            playcount = _extract(artist, 'playcount')
-            artists.append(TopItem(
-                Artist(name, self.username, self.api_key), playcount))
-        return artists
-
-    def get_top_tracks(self, period=None, todate=None):
+        return self._request(
+            'label/topartists', cache, params, 'artist', self._top_artist,
+            columnar)
+
+    def iter_top_artists(self, period=None, todate=None, cache=None):
+        """Yields the top artists as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'label/topartists', cache, params, 'artist', self._top_artist)
+
+    def get_top_tracks(self, period=None, todate=None, cache=None,
+                       columnar=False):
         """Returns a list of the top tracks for a given period"""
 
         params = self._get_params()
@@ -433,18 +2831,23 @@ class Label(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('label/toptracks', False, params)
-        tracks = []
-        for track in doc.getElementsByTagName('track'):
-            title = _extract(track, 'name')
-            artist = _extract(track, 'name', 1)
-            playcount = _number(_extract(track, 'playcount'))
-            tracks.append(TopItem(
-                Track(artist, title, self.username, self.api_key),
-                playcount))
-        return tracks
-
-    def get_top_channels(self, period=None, todate=None):
+        return self._request(
+            'label/toptracks', cache, params, 'track', self._top_track,
+            columnar)
+
+    def iter_top_tracks(self, period=None, todate=None, cache=None):
+        """Yields the top tracks for a given period as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'label/toptracks', cache, params, 'track', self._top_track)
+
+    def get_top_channels(self, period=None, todate=None, cache=None,
+                         columnar=False):
         """Returns a list of the top channels for a given period"""
 
         params = self._get_params()
@@ -452,16 +2855,32 @@ class Label(_BaseObject):
             params['period'] = _period(period)
         if todate:
             params['end'] = _date(todate)
-        doc = self._request('label/topchannels', False, params)
-        channels = []
-        for track in doc.getElementsByTagName('channel'):
-            keyname = _extract(track, 'keyname')
-            playcount = _number(_extract(track, 'playcount'))
-            channels.append(TopItem(
-                Channel(keyname, self.username, self.api_key), playcount))
-        return channels
-
-    def get_matches(self, period=None, todate=None, page=1, limit=50):
+        return self._request(
+            'label/topchannels', cache, params, 'channel', self._top_channel,
+            columnar)
+
+    def iter_top_channels(self, period=None, todate=None, cache=None):
+        """Yields the top channels for a given period as they're parsed"""
+
+        params = self._get_params()
+        if period:
+            params['period'] = _period(period)
+        if todate:
+            params['end'] = _date(todate)
+        return self._iter_request(
+            'label/topchannels', cache, params, 'channel', self._top_channel)
+
+    def get_playcount_series(self, start, end, period=DAY, max_workers=8,
+                             cache=None):
+        """Returns the dates and playcounts of the label for every day, week
+        or month from `start` to `end`, as NumPy arrays if NumPy is
+        installed. Periods that already closed are kept in the series
+        store, so only new ones are requested."""
+        return self._get_playcount_series(
+            'get_top_channels', start, end, period, max_workers, cache)
+
+    def get_matches(self, period=None, todate=None, page=1, limit=50,
+                    cache=None):
         """Returns a list of matches order by date"""
 
         params = self._get_params()
@@ -471,22 +2890,31 @@ class Label(_BaseObject):
             params['end'] = _date(todate)
         params['page'] = _number(page)
         params['limit'] = _number(limit)
-        doc = self._request('label/matches', False, params)
-        matches = []
-        for match in doc.getElementsByTagName('match'):
-            id = _extract(match, 'id')
-            matches.append(Match(id, self.username, self.api_key))
-        return matches
+        return self._request(
+            'label/matches', cache, params, 'match', self._match)
+
+    def iter_matches(self, period=None, todate=None, limit=50, prefetch=2,
+                     cache=None):
+        """Yields the matches of every page for a given period, fetching
+        the next `prefetch` pages in the background"""
+        return _iter_pages(
+            lambda page: self.get_matches(period, todate, page, limit, cache),
+            limit, prefetch)
 
 
 class Match(_BaseObject):
-    """A match"""
+    """A match
 
-    id = None
+    The fields a listing already returns are kept, and the rest are loaded
+    lazily by a single match/info request."""
 
-    def __init__(self, id, username, api_key):
+    __slots__ = ('id', '_fields', '_loaded')
+
+    def __init__(self, id, username, api_key=None, fields=None):
         _BaseObject.__init__(self, username, api_key)
         self.id = id
+        self._fields = fields or {}
+        self._loaded = False
 
     def __repr__(self):
         return "pycast.Match(%s)" % self.id
@@ -494,39 +2922,61 @@ class Match(_BaseObject):
     def _get_params(self):
         return {'match': self.id}
 
+    def _get_fields(self, names, convert):
+        """Returns `convert` applied to the values of some fields, loading
+        the match info if any of them is unknown."""
+        fields = self._fields
+        for name in names:
+            if name not in fields:
+                return self._request(
+                    'match/info', True, build=lambda doc: convert(
+                        *[self._load(doc)[name] for name in names]))
+        return convert(*[fields[name] for name in names])
+
+    def _load(self, doc):
+        """Keeps the fields of a match/info response and returns them."""
+        if not self._loaded:
+            fields = _match_fields(doc)
+            fields.update(self._fields)
+            self._fields = fields
+            self._loaded = True
+        return self._fields
+
+    def _is_complete(self):
+        """Returns True if every field is known without a request."""
+        return self._loaded or len(self._fields) == len(_MATCH_FIELDS)
+
+    def _hydrate(self):
+        if not self._is_complete():
+            self._request('match/info', True, build=self._load)
+        return self
+
     def get_id(self):
-        return id
+        return self.id
 
     def get_datetime(self):
         """Returns the date when the track has matched"""
-        doc = self._request('match/info', True)
-        dt = _extract(doc, 'datetime')
-        return parse_date(dt)
+        return self._get_fields(('datetime',), parse_date)
 
     def get_channel(self):
         """Returns the channel of the match"""
-        doc = self._request('match/info', True)
-        keyname = _extract(doc, 'keyname')
-        return Channel(keyname, self.username, self.api_key)
+        return self._get_fields(('keyname',), self.session.channel)
 
     def get_duration(self):
         """Returns the duration of the match"""
-        doc = self._request('match/info', True)
-        duration = _extract(doc, 'duration')
-        return _number(duration)
+        return self._get_fields(('duration',), _number)
 
     def get_track(self):
         """Returns the track of the match"""
-        doc = self._request('match.info', True)
-        track = _extract(doc, 'name')
-        artist = _extract(doc, 'name', 1)
-        return Track(artist, track, self.username, self.api_key)
+        return self._get_fields(('artist', 'title'), self.session.track)
 
 
 class Chart(_BaseObject):
     """A Vericast chart"""
 
-    def __init__(self, period, todate, username, api_key):
+    __slots__ = ('period', 'todate')
+
+    def __init__(self, period, todate, username, api_key=None):
         """Create a chart object"""
 
         _BaseObject.__init__(self, username, api_key)
@@ -541,50 +2991,319 @@ class Chart(_BaseObject):
         return {'period': _period(self.period),
                 'end': _date(self.todate)}
 
-    def get_top_artists(self):
+    def get_top_artists(self, cache=None, columnar=False):
         """Returns a list of the top artists"""
 
-        doc = self._request('charts/topartists')
-        artists = []
-        for artist in doc.getElementsByTagName('artist'):
-            name = _extract(artist, 'name')
-            playcount = _extract(artist, 'playcount')
-            artists.append(TopItem(
-                Artist(name, self.username, self.api_key), playcount))
-        return artists
+        return self._request(
+            'charts/topartists', cache, None, 'artist', self._top_artist,
+            columnar)
+
+    def iter_top_artists(self, cache=None):
+        """Yields the top artists as they're parsed"""
 
-    def get_top_tracks(self):
+        return self._iter_request(
+            'charts/topartists', cache, None, 'artist', self._top_artist)
+
+    def get_top_tracks(self, cache=None, columnar=False):
         """Returns a list of the top tracks"""
 
-        doc = self._request('charts/toptracks')
-        tracks = []
-        for track in doc.getElementsByTagName('track'):
-            title = _extract(track, 'name')
-            artist = _extract(track, 'name', 1)
-            playcount = _number(_extract(track, 'playcount'))
-            tracks.append(TopItem(
-                Track(artist, title, self.username, self.api_key), playcount))
-        return tracks
-
-    def get_top_labels(self):
+        return self._request(
+            'charts/toptracks', cache, None, 'track', self._top_track,
+            columnar)
+
+    def iter_top_tracks(self, cache=None):
+        """Yields the top tracks as they're parsed"""
+
+        return self._iter_request(
+            'charts/toptracks', cache, None, 'track', self._top_track)
+
+    def get_top_labels(self, cache=None, columnar=False):
         """Returns a list of the top labels"""
 
-        doc = self._request('charts/toplabels')
-        labels = []
-        for label in doc.getElementsByTagName('label'):
-            name = _extract(label, 'name')
-            playcount = _extract(label, 'playcount')
-            labels.append(TopItem(
-                Label(name, self.username, self.api_key), playcount))
-        return labels
+        return self._request(
+            'charts/toplabels', cache, None, 'label', self._top_label,
+            columnar)
+
+    def iter_top_labels(self, cache=None):
+        """Yields the top labels as they're parsed"""
+
+        return self._iter_request(
+            'charts/toplabels', cache, None, 'label', self._top_label)
+
+
+class ChannelCatalog(object):
+    """A local store of the info of many channels.
+
+    The catalog is a single file holding a sorted index of keynames. It is
+    memory-mapped, so lookups and prefix queries don't read it all, and
+    several processes can share it. Updates write a new file and replace
+    the old one atomically; readers pick it up within a second.
+
+        catalog = pycast.ChannelCatalog('/var/lib/pycast/channels')
+        catalog.update(channels)
+        pycast.set_channel_catalog(catalog)
+    """
+
+    _magic = 'PCCAT001'
+    _header = struct.Struct('<8sI')
+    _entry = struct.Struct('<IIII')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._map = None
+        self._count = 0
+        self._stamp = None
+        self._checked = 0
+        self.failures = []
+        self._open()
+
+    def _open(self):
+        """Maps the current catalog file, if any."""
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return
+        stamp = (info.st_ino, info.st_mtime, info.st_size)
+        if stamp == self._stamp:
+            return
+        if not info.st_size:
+            # An empty file, as created by mkstemp, is an empty catalog.
+            self._map, self._count, self._stamp = None, 0, stamp
+            return
+        catalog_file = open(self.path, 'rb')
+        try:
+            mapped = mmap.mmap(
+                catalog_file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            catalog_file.close()
+        magic, count = self._header.unpack_from(mapped)
+        if magic != self._magic:
+            mapped.close()
+            raise ValueError('%s is not a channel catalog' % self.path)
+        self._map, self._count, self._stamp = mapped, count, stamp
+
+    def _check(self):
+        """Reopens the file if another process replaced it."""
+        now = time.time()
+        if now - self._checked < 1:
+            return
+        self._lock.acquire()
+        try:
+            self._checked = now
+            self._open()
+        finally:
+            self._lock.release()
+
+    def _entry_at(self, mapped, index):
+        return self._entry.unpack_from(
+            mapped, self._header.size + index * self._entry.size)
+
+    def _key_at(self, mapped, index):
+        offset, length = self._entry_at(mapped, index)[:2]
+        return mapped[offset:offset + length]
+
+    def _search(self, mapped, count, key):
+        """Returns the index of the first keyname not lower than key."""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(mapped, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _snapshot(self):
+        self._check()
+        self._lock.acquire()
+        try:
+            return self._map, self._count
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return self._snapshot()[1]
+
+    def __contains__(self, keyname):
+        return self.get(keyname) is not None
+
+    def get(self, keyname):
+        """Returns a dict with the name, website and media of a channel,
+        or None if the catalog doesn't know it"""
+        mapped, count = self._snapshot()
+        if mapped is None:
+            return None
+        key = _utf8(keyname)
+        index = self._search(mapped, count, key)
+        if index == count or self._key_at(mapped, index) != key:
+            return None
+        offset, length = self._entry_at(mapped, index)[2:]
+        name, website, media, fetched = json.loads(
+            mapped[offset:offset + length])
+        return {'name': name, 'website': website, 'media': media,
+                'fetched': fetched}
+
+    def keynames(self, prefix=''):
+        """Returns the sorted keynames starting with a prefix, like
+        'gb-radio-'"""
+        mapped, count = self._snapshot()
+        if mapped is None:
+            return []
+        prefix = _utf8(prefix)
+        keynames = []
+        for index in xrange(self._search(mapped, count, prefix), count):
+            key = self._key_at(mapped, index)
+            if not key.startswith(prefix):
+                break
+            keynames.append(key.decode('utf8'))
+        return keynames
+
+    def update(self, channels, max_age=None, max_workers=16):
+        """Fetches the info of the channels the catalog doesn't know, or
+        fetched more than `max_age` seconds ago, and saves them. Returns
+        the number of channels saved; the (channel, exception) pairs of
+        the ones that failed are kept in `failures`.
+        #Parametres:
+          * channels list: Channel objects.
+          * max_age int: Seconds after which an entry is fetched again,
+            None to keep entries for ever.
+          * max_workers int: Number of requests sent at once.
+        """
+        now = time.time()
+        self.failures = []
+        stale = []
+        for channel in channels:
+            info = self.get(channel.get_keyname())
+            if info is None or (max_age is not None and
+                                now - info['fetched'] > max_age):
+                stale.append(channel)
+        if not stale:
+            return 0
+        pool = ThreadPool(min(max_workers, len(stale)))
+        try:
+            fetched = pool.map(_try_fetch_channel_info, stale)
+        finally:
+            pool.close()
+        changes = {}
+        for channel, (info, error) in zip(stale, fetched):
+            if error is None:
+                changes[channel.get_keyname()] = info
+            else:
+                self.failures.append((channel, error))
+        if changes:
+            self._save(changes)
+        return len(changes)
+
+    def refresh(self, session, max_age=None, max_workers=16, prefix=''):
+        """Fetches again the entries older than `max_age` seconds, or all
+        of them if None, among the keynames with the given prefix."""
+        if max_age is None:
+            max_age = -1
+        return self.update(
+            [Channel(keyname, session) for keyname in self.keynames(prefix)],
+            max_age, max_workers)
+
+    def _save(self, changes):
+        """Writes the catalog with some entries added or replaced."""
+        self._lock.acquire()
+        try:
+            self._open()
+            records = {}
+            mapped, count = self._map, self._count
+            for index in xrange(count):
+                key_offset, key_length, offset, length = self._entry_at(
+                    mapped, index)
+                records[mapped[key_offset:key_offset + key_length]] = (
+                    mapped[offset:offset + length])
+            for keyname, info in changes.items():
+                records[_utf8(keyname)] = json.dumps(
+                    [info['name'], info['website'], info['media'],
+                     info['fetched']])
+            keys = sorted(records)
+            offset = self._header.size + len(keys) * self._entry.size
+            index, blobs = [], []
+            for key in keys:
+                value = records[key]
+                index.append(self._entry.pack(
+                    offset, len(key), offset + len(key), len(value)))
+                blobs.append(key)
+                blobs.append(value)
+                offset += len(key) + len(value)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            try:
+                temp_file = os.fdopen(handle, 'wb')
+                try:
+                    temp_file.write(self._header.pack(self._magic, len(keys)))
+                    temp_file.write(''.join(index))
+                    temp_file.write(''.join(blobs))
+                finally:
+                    temp_file.close()
+                os.rename(temp_path, self.path)
+            except:
+                _remove(temp_path)
+                raise
+            self._stamp = None
+            self._open()
+        finally:
+            self._lock.release()
+
+
+def _fetch_channel_info(channel):
+    """Returns a dict with the name, website and media of a channel."""
+    info = channel._request('channel/info', False, build=lambda doc: {
+        'name': _extract(doc, 'name'),
+        'website': _extract(doc, 'website'),
+        'media': _extract(doc, 'media')})
+    info['fetched'] = time.time()
+    return info
+
+
+def _try_fetch_channel_info(channel):
+    """Returns the (info, None) of a channel, or (None, exception)."""
+    try:
+        return _fetch_channel_info(channel), None
+    except Exception, e:
+        return None, e
+
+
+def _slots_state(obj):
+    """Returns a dict with the attributes an object with __slots__ has
+    set, to pickle it with any protocol."""
+    state = {}
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if name != '__weakref__' and hasattr(obj, name):
+                state[name] = getattr(obj, name)
+    return state
+
+
+def _set_slots_state(obj, state):
+    for name, value in state.items():
+        setattr(obj, name, value)
+
+
+def _utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf8')
+    return text
 
 
 class TopItem(object):
 
+    __slots__ = ('item', 'weight')
+
     def __init__(self, item, weight):
         self.item = item
         self.weight = _number(weight)
 
+    def __getstate__(self):
+        return _slots_state(self)
+
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+
     def __repr__(self):
         return ("Item: " + self.get_item().__repr__() +
                 ", Weight: " + str(self.get_weight()))
@@ -598,11 +3317,1318 @@ class TopItem(object):
         return self.weight
 
 
+class TopList(object):
+    """A top-N listing stored by columns.
+
+    Instead of a TopItem per row, the names are kept in `keys` (the titles
+    for tracks, whose artist names are in `artists`) and the playcounts in
+    a single int64 buffer, a NumPy array when NumPy is installed. Sorting,
+    top-k, merging and joining work on whole columns, and to_columns()
+    hands them out without copying, ready for a DataFrame. Iterating
+    yields TopItem objects as usual.
+    """
+
+    __slots__ = ('kind', 'keys', 'artists', 'weights', 'session')
+
+    def __init__(self, kind, keys, weights, artists=None, session=None):
+        self.kind = kind
+        self.keys = keys
+        self.weights = weights
+        self.artists = artists
+        self.session = session
+
+    def __getstate__(self):
+        return _slots_state(self)
+
+    def __setstate__(self, state):
+        _set_slots_state(self, state)
+
+    @classmethod
+    def from_items(cls, items):
+        """Builds a TopList from a list of TopItem"""
+        if not items:
+            return cls(None, [], _int64_array([]))
+        entity = items[0].get_item()
+        kind = entity.__class__.__name__.lower()
+        artists = None
+        if kind == 'track':
+            keys = [item.get_item().get_title() for item in items]
+            artists = [item.get_item().get_artist().get_name()
+                       for item in items]
+        else:
+            keys = [_entity_key(item.get_item()) for item in items]
+        return cls(kind, keys, _int64_array(
+            [item.get_weight() for item in items]), artists, entity.session)
+
+    @classmethod
+    def _parse(cls, kind, nodes, session):
+        """Builds a TopList straight from the parsed `kind` elements."""
+        field = 'name'
+        if kind == 'channel':
+            field = 'keyname'
+        keys = []
+        artists = None
+        if kind == 'track':
+            artists = []
+        weights = array(_INT64_CODE)
+        for node in nodes:
+            keys.append(_extract(node, field))
+            if artists is not None:
+                artists.append(_extract(node, 'name', 1))
+            weights.append(_number(_extract(node, 'playcount')))
+        return cls(kind, keys, _int64_array(weights), artists, session)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for index in xrange(len(self.keys)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        return TopItem(self._entity(index), self.weights[index])
+
+    def __repr__(self):
+        return "pycast.TopList(%r, %d items)" % (self.kind, len(self))
+
+    def _entity(self, index):
+        key = self.keys[index]
+        if self.kind == 'track':
+            return self.session.track(self.artists[index], key)
+        return getattr(self.session, self.kind)(key)
+
+    def _key(self, index):
+        if self.artists is not None:
+            return self.artists[index], self.keys[index]
+        return self.keys[index]
+
+    def _take(self, indices):
+        """Returns a TopList with the rows at the given indices."""
+        artists = None
+        if self.artists is not None:
+            artists = [self.artists[index] for index in indices]
+        if numpy is not None:
+            weights = self.weights[numpy.asarray(indices, dtype=numpy.intp)]
+        else:
+            weights = array(_INT64_CODE, [self.weights[i] for i in indices])
+        return TopList(self.kind, [self.keys[index] for index in indices],
+                       weights, artists, self.session)
+
+    def copy(self):
+        """Returns a copy that doesn't share its columns"""
+        artists = self.artists
+        if artists is not None:
+            artists = list(artists)
+        return TopList(self.kind, list(self.keys), _int64_array(self.weights),
+                       artists, self.session)
+
+    def get_keys(self):
+        """Returns the keys of the rows, (artist, title) for tracks"""
+        return [self._key(index) for index in xrange(len(self))]
+
+    def get_weights(self):
+        """Returns the playcounts column"""
+        return self.weights
+
+    def sort(self, reverse=True):
+        """Returns the list sorted by weight, heaviest first unless
+        `reverse` is False. Rows with equal weights keep their order."""
+        if numpy is not None:
+            weights = self.weights
+            if reverse:
+                weights = -weights
+            return self._take(numpy.argsort(weights, kind='mergesort'))
+        return self._take(sorted(
+            xrange(len(self)), key=self.weights.__getitem__, reverse=reverse))
+
+    def top(self, k):
+        """Returns the k heaviest rows, sorted by weight"""
+        if numpy is not None and k < len(self):
+            indices = numpy.argpartition(-self.weights, k)[:k]
+            indices.sort()
+            return self._take(indices).sort()
+        return self.sort()._take(range(min(k, len(self))))
+
+    def merge(self, *others):
+        """Returns the sum of the weights of several lists of the same
+        kind by key, sorted by weight"""
+        lists = (self,) + others
+        positions = {}
+        rows = []
+        codes = []
+        for toplist in lists:
+            for index in xrange(len(toplist)):
+                key = toplist._key(index)
+                code = positions.get(key)
+                if code is None:
+                    code = positions[key] = len(rows)
+                    rows.append((toplist, index))
+                codes.append(code)
+        keys = [toplist.keys[index] for toplist, index in rows]
+        artists = None
+        if self.artists is not None:
+            artists = [toplist.artists[index] for toplist, index in rows]
+        if numpy is not None:
+            weights = numpy.zeros(len(rows), dtype=numpy.int64)
+            numpy.add.at(weights, numpy.asarray(codes, dtype=numpy.intp),
+                         numpy.concatenate([l.weights for l in lists]))
+        else:
+            weights = array(_INT64_CODE, [0] * len(rows))
+            position = 0
+            for toplist in lists:
+                for weight in toplist.weights:
+                    weights[codes[position]] += weight
+                    position += 1
+        return TopList(self.kind, keys, weights, artists,
+                       self.session).sort()
+
+    def join(self, *others):
+        """Returns the rows whose key is in every list, as columns: `key`
+        and the weights of each list in `weight_0`, `weight_1`, ..."""
+        positions = []
+        for other in others:
+            positions.append(dict(
+                (other._key(index), index) for index in xrange(len(other))))
+        rows = []
+        matches = [[] for other in others]
+        for index in xrange(len(self)):
+            key = self._key(index)
+            found = [position.get(key) for position in positions]
+            if None in found:
+                continue
+            rows.append(index)
+            for column, other_index in zip(matches, found):
+                column.append(other_index)
+        columns = self._take(rows).to_columns()
+        columns['weight_0'] = columns.pop('weight')
+        for number, (other, indices) in enumerate(zip(others, matches)):
+            columns['weight_%d' % (number + 1)] = other._take(
+                indices).weights
+        return columns
+
+    def to_columns(self):
+        """Returns a dict of the columns, sharing their buffers, which
+        pandas.DataFrame accepts as is"""
+        columns = OrderedDict()
+        if self.artists is not None:
+            columns['artist'] = self.artists
+        columns['key'] = self.keys
+        columns['weight'] = self.weights
+        return columns
+
+
+def _iterparse(source, tag=None):
+    """Parses a response body in a single incremental pass.
+
+    The response status is checked as soon as it is read, raising a
+    ServiceException for errors. Yields every `tag` element once it is
+    complete and drops it from the tree afterwards, so memory stays flat
+    however long the listing is. Without a `tag`, yields the root element
+    once the whole response is parsed."""
+    parents = []
+    failed = False
+    for event, node in ElementTree.iterparse(source, ('start', 'end')):
+        if event == 'start':
+            if node.tag == 'response':
+                failed = node.get('status') != 'ok'
+            parents.append(node)
+            continue
+        parents.pop()
+        if failed:
+            if node.tag == 'error':
+                raise ServiceException(
+                    node.get('code'), (node.text or '').strip())
+        elif node.tag == tag:
+            yield node
+            if parents:
+                parents[-1].remove(node)
+    if failed:
+        raise ServiceException(None, 'Unknown error')
+    if tag is None:
+        yield node
+
+
+def _parse(source):
+    """Parses a whole response body and returns its root element."""
+    for root in _iterparse(source):
+        return root
+
+
 def _extract(node, name, index=0):
     """Extracts a value from the xml string"""
-    nodes = node.getElementsByTagName(name)
-    if len(nodes) and nodes[index].firstChild:
-        return nodes[index].firstChild.data.strip()
+    for child in node.iter(name):
+        if child is node:
+            continue
+        if not index:
+            if child.text:
+                return child.text.strip()
+            return None
+        index -= 1
+
+
+class BatchResult(object):
+    """The outcome of one call of a batch"""
+
+    def __init__(self, index, entity, method, kwargs, result, error):
+        self.index = index
+        self.entity = entity
+        self.method = method
+        self.kwargs = kwargs
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return "pycast.BatchResult(%d, error=%r)" % (
+                self.index, self.error)
+        return "pycast.BatchResult(%d)" % self.index
+
+    def failed(self):
+        """Returns True if the call raised an exception"""
+        return self.error is not None
+
+    def get_result(self):
+        """Returns the value of the call, raising its error if it failed"""
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def get_error(self):
+        """Returns the exception raised by the call or None"""
+        return self.error
+
+
+def run_batch(calls, max_workers=8, processes=False, ordered=False):
+    """Runs many queries concurrently and yields their BatchResult.
+    #Parametres:
+      * calls iterable: (entity, method name, kwargs) tuples, like
+        (artist, 'get_top_channels', {'period': pycast.DAY}).
+      * max_workers int: Maximum number of calls running at once.
+      * processes bool: Use a pool of processes instead of threads.
+      * ordered bool: Yield the results in the order of the calls instead
+        of as they complete.
+    An exception raised by a call, ServiceException included, is kept in
+    its result instead of stopping the batch.
+    """
+    if processes:
+        pool = Pool(max_workers)
+    else:
+        pool = ThreadPool(max_workers)
+    try:
+        tasks = ((index, call, processes) for index, call in enumerate(calls))
+        if ordered:
+            results = pool.imap(_run_call, tasks)
+        else:
+            results = pool.imap_unordered(_run_call, tasks)
+        for index, call, result, error in results:
+            yield BatchResult(
+                index, call[0], call[1], _call_kwargs(call), result, error)
+    finally:
+        pool.terminate()
+
+
+def _run_call(task):
+    """Runs a batch call returning its (index, call, result, error)."""
+    index, call, processes = task
+    try:
+        result = getattr(call[0], call[1])(**_call_kwargs(call))
+    except Exception, e:
+        if processes:
+            try:
+                pickle.dumps(e, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                e = Exception(repr(e))
+        return index, call, None, e
+    return index, call, result, None
+
+
+def _call_kwargs(call):
+    if len(call) > 2 and call[2]:
+        return call[2]
+    return {}
+
+
+class Deferred(object):
+    """The eventual result of an asynchronous request"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._value = None
+        self._error = None
+
+    def done(self):
+        """Returns True once the result is available"""
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the result and returns it, raising its error if any.
+        Raises DeadlineExceeded if it takes more than `timeout` seconds."""
+        if not self._event.wait(timeout):
+            _count_request('timeouts')
+            raise DeadlineExceeded(None, 'Deadline exceeded')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def add_callback(self, callback):
+        """Calls `callback(deferred)` once the result is available"""
+        self._lock.acquire()
+        if not self._event.is_set():
+            self._callbacks.append(callback)
+            self._lock.release()
+            return
+        self._lock.release()
+        callback(self)
+
+    def _chain(self, function):
+        """Returns a Deferred of `function` applied to this result."""
+        chained = Deferred()
+
+        def callback(deferred):
+            try:
+                chained._set_result(function(deferred.result()))
+            except Exception, e:
+                chained._set_exception(e)
+
+        self.add_callback(callback)
+        return chained
+
+    def _set_result(self, value):
+        self._value = value
+        self._complete()
+
+    def _set_exception(self, error):
+        self._error = error
+        self._complete()
+
+    def _complete(self):
+        self._lock.acquire()
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+
+class AsyncClient(object):
+    """Sends requests without blocking on a shared non-blocking transport.
+
+    Objects wrapped by the client mirror their usual methods, but the ones
+    that query Vericast return a Deferred right away:
+
+        client = pycast.AsyncClient()
+        channels = client.wrap(artist).get_top_channels(period=pycast.DAY)
+        print channels.result()
+    """
+
+    def __init__(self, max_in_flight=100, idle_timeout=60):
+        self._transport = _AsyncTransport(max_in_flight, idle_timeout)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def wrap(self, entity):
+        """Returns an asynchronous version of an Artist, Track, Channel,
+        Label, Match or Chart"""
+        return _AsyncProxy(self, entity)
+
+    def close(self):
+        """Closes the connections once the running requests are done"""
+        self._transport.close()
+
+    def get_stats(self):
+        """Returns a dict with the counters of the transport"""
+        return self._transport.get_stats()
+
+    def _submit(self, request, cacheable, handler, ttl=None):
+        if handler is None:
+            handler = _parse
+        request.cache_control = _cache_control(cacheable, ttl)
+        caching = is_caching_enabled() and cacheable
+        stale = None
+        if caching:
+            response, validators, fresh = request._get_cached_entry()
+            if validators and not fresh:
+                stale = response, validators
+            if fresh:
+                deferred = Deferred()
+                try:
+                    deferred._set_result(
+                        request._parse_response(handler, response))
+                except Exception, e:
+                    deferred._set_exception(e)
+                return deferred
+        pool = _get_credential_pool()
+        host, path, headers = request._get_location(pool and pool.pick())
+        _add_validators(headers, stale and stale[1])
+        key = request._get_flight_key()
+        if stale is not None:
+            key += ' conditional'
+        at = _get_deadline()
+        start = time.time()
+
+        def parse(answer):
+            status, reason, response_headers, response = answer
+            _emit('download', request.method, time.time() - start,
+                  {'bytes': len(response), 'status': status})
+            if status == 304 and stale is not None:
+                response, validators = stale
+            else:
+                decoder = _decoder(response_headers)
+                if decoder is not None:
+                    response = (decoder.decompress(response) +
+                                decoder.flush())
+                _check_status(host, path, status, reason, response_headers,
+                              response)
+                validators = _validators(response_headers)
+            if stale is not None:
+                _emit('revalidate', request.method, 0,
+                      {'modified': response is not stale[0]})
+            result = request._parse_response(handler, response)
+            if caching:
+                request._cache_response(response, ttl, validators)
+            _emit('request', request.method, time.time() - start)
+            return result
+
+        def failed(deferred):
+            if deferred._error is not None:
+                _emit('error', request.method, time.time() - start,
+                      {'error': deferred._error.__class__.__name__})
+
+        result = self._fetch(key, host, path, headers, at)._chain(parse)
+        result.add_callback(failed)
+        return result
+
+    def _fetch(self, key, host, path, headers, at=None):
+        """Returns a Deferred response, shared by the identical requests
+        in flight, which fails once the deadline `at` of the first of them
+        passes."""
+        self._lock.acquire()
+        try:
+            deferred = self._in_flight.get(key)
+            if deferred is None:
+                deferred = self._transport.fetch(host, path, headers, at)
+                self._in_flight[key] = deferred
+                deferred.add_callback(lambda done: self._forget(key))
+            return deferred
+        finally:
+            self._lock.release()
+
+    def _forget(self, key):
+        self._lock.acquire()
+        self._in_flight.pop(key, None)
+        self._lock.release()
+
+
+def _done_deferred(value):
+    """Returns a Deferred already holding a value."""
+    deferred = Deferred()
+    deferred._set_result(value)
+    return deferred
+
+
+class _AsyncProxy(object):
+    """An object whose queries return Deferred results."""
+
+    def __init__(self, client, entity):
+        self._entity = copy.copy(entity)
+        self._entity._async = client
+
+    def __repr__(self):
+        return repr(self._entity)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._entity, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def method(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if not isinstance(result, Deferred):
+                return _done_deferred(result)
+            return result
+
+        return method
+
+    def iter_matches(self, period=None, todate=None, limit=50, window=4,
+                     cache=None):
+        """Yields the matches of every page for a given period, keeping
+        `window` pages requested at once"""
+        def start(page):
+            deferred = self._entity.get_matches(
+                period, todate, page, limit, cache)
+            return deferred.result, deferred.done
+
+        return _iter_window(start, limit, window)
+
+
+class _ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        method, _, query = self.path.partition('?')
+        try:
+            params = _parse_query(query)
+        except UnicodeDecodeError:
+            status, body = 400, ''
+        else:
+            try:
+                status, body = self.server.proxy.handle(
+                    method.lstrip('/'), params,
+                    self.headers.get('Cache-Control'))
+            except Exception:
+                # Answer rather than drop the connection of the client.
+                status, body = 500, ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _UnixProxyHandler(_ProxyHandler):
+
+    # Unix sockets have no Nagle algorithm.
+    disable_nagle_algorithm = False
+
+
+class _TCPProxyServer(SocketServer.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class _UnixProxyServer(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class ProxyServer(object):
+    """A local caching proxy of the web service, shared by many processes.
+
+    The requests of the processes that call set_proxy go through the
+    connection pool, cache and request coalescing of the proxy, which
+    caches what each request allows:
+
+        pycast daemon --listen unix:/var/run/pycast.sock \\
+            --cache-dir /var/cache/pycast
+        pycast.set_proxy('unix:/var/run/pycast.sock')
+    """
+
+    def __init__(self, address='127.0.0.1:8437'):
+        """Create a proxy listening on a 'host:port' or 'unix:/path'."""
+        self.address = address
+        if address.startswith('unix:'):
+            path = address[len('unix:'):]
+            _remove(path)
+            self._server = _UnixProxyServer(path, _UnixProxyHandler)
+        else:
+            host, _, port = address.rpartition(':')
+            self._server = _TCPProxyServer((host, int(port)), _ProxyHandler)
+            self.address = '%s:%d' % self._server.server_address[:2]
+        self._server.proxy = self
+
+    def handle(self, method, params, cache_control=None):
+        """Returns the (status, body) of the answer to a request."""
+        request = _Request(method, params, params.pop('user', None),
+                           params.pop('api', None))
+        # Even if this process sends its own requests to a proxy.
+        request.direct = True
+        cacheable, ttl = _parse_cache_control(cache_control, params)
+        cacheable = cacheable and is_caching_enabled()
+        stale = None
+        if cacheable:
+            body, validators, fresh = request._get_cached_entry()
+            if fresh:
+                return 200, body
+            if validators:
+                stale = body, validators
+        at = _get_deadline()
+        fetch = lambda: request._fetch_response(at, stale and stale[1])
+        policy = _get_transport_policy()
+        try:
+            if policy is None:
+                body, validators = fetch()
+            else:
+                body, validators = policy.call(fetch, at)
+        except urllib2.HTTPError, e:
+            return e.code, e.read()
+        except (urllib2.URLError, httplib.HTTPException, socket.error,
+                ServiceException), e:
+            return 502, ''
+        if body is None:
+            body = stale[0]
+        if cacheable and _response_ok(body):
+            request._cache_response(body, ttl, validators)
+        return 200, body
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serves requests on a daemon thread."""
+        _spawn(self.serve_forever)
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self.address.startswith('unix:'):
+            _remove(self.address[len('unix:'):])
+
+
+def _cache_control(cacheable, ttl):
+    """Returns the Cache-Control header telling a proxy how to cache."""
+    if not cacheable:
+        return 'no-store'
+    if ttl is None:
+        return 'immutable'
+    return 'max-age=%d' % ttl
+
+
+def _parse_query(query):
+    """Returns the params of a query string as unicode. Raises
+    UnicodeDecodeError if they are not UTF-8:
+
+        >>> sorted(_parse_query('artist=Bj%C3%B6rk&period=1').items())
+        [('artist', u'Bj\\xf6rk'), ('period', u'1')]
+    """
+    return dict((name, value.decode('utf8'))
+                for name, value in urlparse.parse_qsl(query, True))
+
+
+def _parse_cache_control(header, params):
+    """Returns the (cacheable, ttl) a Cache-Control header allows, and
+    the default policy of the request if there is no header."""
+    if not header:
+        return _cache_policy(None, params)
+    header = header.strip()
+    if header == 'immutable':
+        return True, None
+    if header.startswith('max-age='):
+        return True, int(header[len('max-age='):])
+    return False, None
+
+
+def _response_ok(body):
+    """Returns True if a response body has an ok status."""
+    try:
+        for event, node in ElementTree.iterparse(StringIO(body), ('start',)):
+            return node.get('status') == 'ok'
+    except SyntaxError:
+        pass
+    return False
+
+
+def _response_error(body):
+    """Returns the error code of a failed response body, or None."""
+    try:
+        for event, node in ElementTree.iterparse(StringIO(body),
+                                                 ('start', 'end')):
+            if event == 'start':
+                if node.tag == 'response' and node.get('status') == 'ok':
+                    return None
+            elif node.tag == 'error':
+                return node.get('code')
+    except SyntaxError:
+        pass
+    return None
+
+
+class Backfill(object):
+    """Runs a query for every day, week or month of a date range, and can
+    resume where it stopped.
+
+    Each (entity, period end) pair is a work unit. Completed units are
+    appended to a checkpoint file, and units found there are skipped, so
+    running the same backfill again after a crash only does what is left:
+
+        backfill = pycast.Backfill(channels, 'get_top_tracks',
+                                   datetime.date(2010, 1, 1),
+                                   datetime.date(2012, 12, 31),
+                                   checkpoint='tracks.checkpoint')
+        backfill.run(lambda channel, day, tracks: save(channel, day, tracks))
+    """
+
+    def __init__(self, entities, method, start, end, period=DAY,
+                 checkpoint=None, kwargs=None, order='asc', priority=None):
+        """Create a backfill.
+        #Parametres:
+          * entities list: Artist, Track, Channel or Label objects.
+          * method str: Method taking period and todate, like
+            'get_top_tracks'.
+          * start date: First day of the range.
+          * end date: Last day of the range.
+          * period int: DAY, WEEK or MONTH, the size of the work units.
+          * checkpoint str: File keeping the completed units.
+          * kwargs dict: Other arguments of the method.
+          * order str: 'asc' to run the oldest units first, 'desc' for the
+            newest first.
+          * priority callable: Takes an entity and a date and returns a
+            sort key, lower keys run first. Overrides `order`.
+        """
+        self.entities = list(entities)
+        self.method = method
+        self.start = start
+        self.end = end
+        self.period = period
+        self.checkpoint = checkpoint
+        self.kwargs = kwargs or {}
+        self.order = order
+        self.priority = priority
+        self.failures = []
+        self._done = set()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            checkpoint_file = open(checkpoint, 'rb')
+            try:
+                for line in checkpoint_file:
+                    # A line without its newline was cut by a crash.
+                    if line.endswith('\n'):
+                        self._done.add(line[:-1].decode('utf8'))
+            finally:
+                checkpoint_file.close()
+
+    def _key(self, entity, todate):
+        return u'\t'.join((_entity_source(entity), self.method,
+                           _period(self.period), _date(todate)))
+
+    def get_units(self):
+        """Returns the (entity, period end) pairs still to do, in the
+        order they will run"""
+        units = []
+        for todate in _period_ends(self.start, self.end, self.period):
+            for entity in self.entities:
+                if self._key(entity, todate) not in self._done:
+                    units.append((entity, todate))
+        if self.priority is not None:
+            units.sort(key=lambda unit: self.priority(*unit))
+        elif self.order == 'desc':
+            units.sort(key=lambda unit: unit[1], reverse=True)
+        return units
+
+    def run(self, handler, max_workers=4):
+        """Runs the pending units on a pool of threads.
+
+        `handler(entity, todate, result)` is called from the calling thread
+        with the result of each unit as it completes, and the unit is
+        checkpointed once it returns. Units that raise an exception are
+        kept in `failures` and will run again next time. Returns the
+        number of units completed."""
+        units = self.get_units()
+        calls = []
+        for entity, todate in units:
+            kwargs = dict(self.kwargs)
+            kwargs['period'] = self.period
+            kwargs['todate'] = todate
+            calls.append((entity, self.method, kwargs))
+        self.failures = []
+        checkpoint_file = None
+        if self.checkpoint is not None:
+            checkpoint_file = open(self.checkpoint, 'ab')
+        done = 0
+        try:
+            for result in run_batch(calls, max_workers):
+                entity, todate = units[result.index]
+                if result.failed():
+                    self.failures.append((entity, todate, result.error))
+                    continue
+                handler(entity, todate, result.result)
+                key = self._key(entity, todate)
+                self._done.add(key)
+                if checkpoint_file is not None:
+                    checkpoint_file.write(key.encode('utf8') + '\n')
+                    checkpoint_file.flush()
+                    os.fsync(checkpoint_file.fileno())
+                done += 1
+        finally:
+            if checkpoint_file is not None:
+                checkpoint_file.close()
+        return done
+
+
+def _period_ends(start, end, period):
+    """Returns the last day of every day, week or month of a range."""
+    ends = []
+    if period == MONTH:
+        day = start
+        while day <= end:
+            following = datetime.date(
+                day.year + day.month // 12, day.month % 12 + 1, 1)
+            ends.append(min(following - datetime.timedelta(days=1), end))
+            day = following
+    else:
+        step = datetime.timedelta(days=period == WEEK and 7 or 1)
+        day = start
+        while day <= end:
+            ends.append(min(day + step - datetime.timedelta(days=1), end))
+            day += step
+    return ends
+
+
+class SeriesStore(object):
+    """Keeps the playcounts of periods that already closed, so playcount
+    series only request the new ones.
+
+    The counts are kept in memory, and also in a SQLite file if a `path`
+    is given, to be reused by later runs and other processes:
+
+        pycast.set_series_store(pycast.SeriesStore('/var/lib/pycast/series'))
+    """
+
+    def __init__(self, path=None):
+        if path is not None and sqlite3 is None:
+            raise ImportError('SeriesStore needs the sqlite3 module')
+        self.path = path
+        self._counts = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if path is not None:
+            self._connection().execute(
+                'CREATE TABLE IF NOT EXISTS series (source TEXT, '
+                'period INTEGER, day TEXT, count INTEGER, '
+                'PRIMARY KEY (source, period, day))')
+
+    def _connection(self):
+        """Returns the connection of the current thread and process."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, source, period, days):
+        """Returns a dict with the known counts of some of `days`."""
+        self._lock.acquire()
+        try:
+            known = self._counts.setdefault((source, period), {})
+            counts = dict((day, known[day]) for day in days if day in known)
+        finally:
+            self._lock.release()
+        missing = [day for day in days if day not in counts]
+        if self.path is not None and missing:
+            rows = self._connection().execute(
+                'SELECT day, count FROM series WHERE source = ? AND '
+                'period = ? AND day BETWEEN ? AND ?',
+                (source, period, _date(min(missing)), _date(max(missing))))
+            stored = dict(rows.fetchall())
+            for day in missing:
+                count = stored.get(_date(day))
+                if count is not None:
+                    counts[day] = count
+            self._lock.acquire()
+            known.update(counts)
+            self._lock.release()
+        return counts
+
+    def set(self, source, period, counts):
+        """Stores a dict of counts by day."""
+        if not counts:
+            return
+        self._lock.acquire()
+        try:
+            self._counts.setdefault((source, period), {}).update(counts)
+        finally:
+            self._lock.release()
+        if self.path is not None:
+            self._connection().executemany(
+                'INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?)',
+                [(source, period, _date(day), count)
+                 for day, count in counts.items()])
+
+    def clear(self):
+        self._lock.acquire()
+        self._counts.clear()
+        self._lock.release()
+        if self.path is not None:
+            self._connection().execute('DELETE FROM series')
+
+
+class MatchStore(object):
+    """A local store of play counts aggregated from matches.
+
+    Matches are added once each, to counters of plays per day, channel,
+    artist, track and label kept in a SQLite file. Top-N listings of any
+    date range are then answered locally, as lists of TopItem:
+
+        store = pycast.MatchStore('/var/lib/pycast/plays', session)
+        store.update(channels, datetime.date(2012, 3, 1),
+                     datetime.date(2012, 3, 31))
+        artists = store.get_top_artists(datetime.date(2012, 3, 10),
+                                        datetime.date(2012, 3, 20),
+                                        channel=bbc, limit=10)
+
+    Matches don't tell their label, so labels are only counted for the
+    matches added with one, like the ones updated from a Label.
+    """
+
+    def __init__(self, path, username, api_key=None):
+        """Create a match store.
+        #Parametres:
+          * path str: Path of the SQLite database file.
+          * username str: Username of the objects listed, or a Session.
+          * api_key str: The api key of the user.
+        """
+        if sqlite3 is None:
+            raise ImportError('MatchStore needs the sqlite3 module')
+        self.path = path
+        if isinstance(username, Session):
+            self.session = username
+        else:
+            self.session = _get_session(username, api_key)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS matches (id TEXT PRIMARY KEY, '
+            'label TEXT)')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS plays (day TEXT, channel TEXT, '
+            'artist TEXT, title TEXT, label TEXT, plays INTEGER, '
+            'PRIMARY KEY (day, channel, artist, title, label))')
+
+    def _connection(self):
+        """Returns the connection of the current thread and process."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def add(self, matches, label=None):
+        """Counts the plays of matches that were not added before, and
+        moves to `label` the ones added without a label.
+        #Parametres:
+          * matches list: Match objects.
+          * label Label: The label of all the matches, if known.
+        Returns the number of matches counted."""
+        rows = []
+        for match in hydrate_matches(matches):
+            track = match.get_track()
+            rows.append((match.get_id(), _date(match.get_datetime()),
+                         match.get_channel().get_keyname(),
+                         track.get_artist().get_name(), track.get_title()))
+        label = label is not None and label.get_name() or u''
+        connection = self._connection()
+        added = 0
+        self._lock.acquire()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                for row in rows:
+                    if connection.execute(
+                            'INSERT OR IGNORE INTO matches VALUES (?, ?)',
+                            (row[0], label)).rowcount:
+                        self._count(connection, row[1:] + (label,), 1)
+                        added += 1
+                    elif label and connection.execute(
+                            "UPDATE matches SET label = ? WHERE id = ? "
+                            "AND label = ''", (label, row[0])).rowcount:
+                        self._count(connection, row[1:] + (u'',), -1)
+                        self._count(connection, row[1:] + (label,), 1)
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            self._lock.release()
+        return added
+
+    def _count(self, connection, counter, plays):
+        connection.execute(
+            'INSERT OR IGNORE INTO plays VALUES (?, ?, ?, ?, ?, 0)', counter)
+        connection.execute(
+            'UPDATE plays SET plays = plays + ? WHERE day = ? AND '
+            'channel = ? AND artist = ? AND title = ? AND label = ?',
+            (plays,) + counter)
+
+    def update(self, entities, start, end, max_workers=4, limit=50,
+               prefetch=2):
+        """Adds the matches of many entities over a date range.
+        #Parametres:
+          * entities list: Channel, Artist, Track or Label objects.
+          * start date: First day of the range.
+          * end date: Last day of the range.
+          * max_workers int: Number of entities fetched at once.
+          * limit int: Matches per page.
+          * prefetch int: Pages fetched ahead for each entity.
+        Returns the number of new matches counted."""
+        jobs = [(entity, start, end, limit, prefetch) for entity in entities]
+        if not jobs:
+            return 0
+        pool = ThreadPool(min(max_workers, len(jobs)))
+        try:
+            counts = pool.map(self._update_entity, jobs, 1)
+        finally:
+            pool.close()
+        return sum(counts)
+
+    def _update_entity(self, job):
+        entity, start, end, limit, prefetch = job
+        label = isinstance(entity, Label) and entity or None
+        count = 0
+        matches = _iter_range_matches(entity, start, end, limit, prefetch)
+        for page in _chunks(matches, limit):
+            count += self.add(page, label)
+        return count
+
+    def _top(self, field, start, end, channel, artist, track, label, limit,
+             columnar):
+        """Returns the TopItems of `field` with the most plays."""
+        columns = field
+        if field == 'title':
+            columns = 'artist, title'
+        query = ('SELECT %s, SUM(plays) AS total FROM plays '
+                 'WHERE day BETWEEN ? AND ?' % columns)
+        params = [_date(start), _date(end)]
+        if channel is not None:
+            query += ' AND channel = ?'
+            params.append(channel.get_keyname())
+        if artist is not None:
+            query += ' AND artist = ?'
+            params.append(artist.get_name())
+        if track is not None:
+            query += ' AND artist = ? AND title = ?'
+            params.extend((track.get_artist().get_name(), track.get_title()))
+        if label is not None:
+            query += ' AND label = ?'
+            params.append(label.get_name())
+        elif field == 'label':
+            query += " AND label != ''"
+        query += (' GROUP BY %s HAVING total > 0 ORDER BY total DESC, %s'
+                  % (columns, columns))
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        build = {'channel': self.session.channel,
+                 'artist': self.session.artist,
+                 'title': self.session.track,
+                 'label': self.session.label}[field]
+        items = [TopItem(build(*row[:-1]), row[-1])
+                 for row in self._connection().execute(query, params)]
+        if columnar:
+            return TopList.from_items(items)
+        return items
+
+    def get_top_artists(self, start, end, channel=None, track=None,
+                        label=None, limit=None, columnar=False):
+        """Returns the artists with the most plays from start to end,
+        optionally only on a channel, of a track or of a label"""
+        return self._top('artist', start, end, channel, None, track, label,
+                         limit, columnar)
+
+    def get_top_tracks(self, start, end, channel=None, artist=None,
+                       label=None, limit=None, columnar=False):
+        """Returns the tracks with the most plays from start to end,
+        optionally only on a channel, of an artist or of a label"""
+        return self._top('title', start, end, channel, artist, None, label,
+                         limit, columnar)
+
+    def get_top_channels(self, start, end, artist=None, track=None,
+                         label=None, limit=None, columnar=False):
+        """Returns the channels with the most plays from start to end,
+        optionally only of an artist, a track or a label"""
+        return self._top('channel', start, end, None, artist, track, label,
+                         limit, columnar)
+
+    def get_top_labels(self, start, end, channel=None, artist=None,
+                       track=None, limit=None, columnar=False):
+        """Returns the labels with the most plays from start to end,
+        optionally only on a channel, of an artist or of a track"""
+        return self._top('label', start, end, channel, artist, track, None,
+                         limit, columnar)
+
+
+def _iter_pages(fetch, limit, prefetch):
+    """Yields the items of every page returned by `fetch(page)`.
+
+    The next `prefetch` pages are requested in the background while the
+    current one is consumed. Stops after the first short or empty page."""
+    if prefetch < 1:
+        return _iter_window(
+            lambda page: (lambda: fetch(page), lambda: False), limit, 1)
+    return _iter_prefetched(fetch, limit, prefetch)
+
+
+def _iter_prefetched(fetch, limit, prefetch):
+    pool = ThreadPool(prefetch + 1)
+
+    def start(page):
+        result = pool.apply_async(fetch, (page,))
+        return result.get, result.ready
+
+    try:
+        for item in _iter_window(start, limit, prefetch + 1):
+            yield item
+    finally:
+        # Pages fetched past the end are let finish in the background.
+        pool.close()
+
+
+def _iter_window(start, limit, window):
+    """Yields the items of every page, keeping `window` pages requested.
+
+    `start(page)` begins fetching a page and returns a function that waits
+    for its items and one telling whether they arrived. No more pages are
+    requested once one of them came back short."""
+    pending = deque()
+    for page in range(1, window + 1):
+        pending.append(start(page))
+    while True:
+        items = pending.popleft()[0]()
+        for item in items:
+            yield item
+        if len(items) < limit:
+            return
+        # Scheduled once the page is consumed, which leaves the pages in
+        # flight the most time to tell where the listing ends.
+        if not any(_is_last_page(p, limit) for p in pending):
+            page += 1
+            pending.append(start(page))
+
+
+def _iter_keyed_pages(fetch, keys, limit, prefetch):
+    """Yields the items of every page of every key, key after key, from
+    `fetch(key, page)`.
+
+    Up to `prefetch` + 1 pages are kept requested, and only pages known to
+    exist: the first page of every key, and the next page of a key once
+    its last one came back full. Nothing is requested past the end."""
+    keys = list(keys)
+    pages = [[] for key in keys]
+    state = {'pending': 0, 'next': 0}
+    pool = ThreadPool(prefetch + 1)
+
+    def request(index):
+        pages[index].append(pool.apply_async(
+            fetch, (keys[index], len(pages[index]) + 1)))
+        state['pending'] += 1
+        state['next'] = max(state['next'], index + 1)
+
+    def fill(current):
+        while state['pending'] <= prefetch:
+            for index in range(current, state['next']):
+                last = pages[index] and pages[index][-1]
+                if last and _is_full_page(last, limit):
+                    request(index)
+                    break
+            else:
+                if state['next'] == len(keys):
+                    return
+                request(state['next'])
+
+    try:
+        for index in range(len(keys)):
+            page = 0
+            while True:
+                fill(index)
+                if page == len(pages[index]):
+                    request(index)
+                items = pages[index][page].get()
+                pages[index][page] = None
+                state['pending'] -= 1
+                page += 1
+                if len(items) == limit and page == len(pages[index]):
+                    request(index)
+                fill(index)
+                for item in items:
+                    yield item
+                if len(items) < limit:
+                    break
+    finally:
+        pool.close()
+
+
+def _is_full_page(result, limit):
+    """Tells whether a requested page arrived with `limit` items"""
+    if not result.ready():
+        return False
+    try:
+        return len(result.get()) == limit
+    except Exception:
+        return False
+
+
+def _is_last_page(page, limit):
+    """Tells whether a requested page arrived and ends the listing"""
+    wait, ready = page
+    if not ready():
+        return False
+    try:
+        return len(wait()) < limit
+    except Exception:
+        # The error is raised when the page is consumed.
+        return True
+
+
+def _int64_array(values):
+    """Returns an int64 column, a NumPy array if NumPy is installed."""
+    if numpy is None:
+        return array(_INT64_CODE, values)
+    if isinstance(values, array) and values.typecode == 'l':
+        return numpy.frombuffer(values, dtype=numpy.int64)
+    return numpy.array(values, dtype=numpy.int64)
+
+
+def _entity_key(entity):
+    """Returns the name or keyname identifying an entity."""
+    if isinstance(entity, Channel):
+        return entity.get_keyname()
+    return entity.get_name()
+
+
+def _entity_source(entity):
+    """Returns a string identifying an entity and its kind."""
+    if isinstance(entity, Track):
+        name = u'%s - %s' % (entity.get_artist().get_name(),
+                             entity.get_title())
+    else:
+        name = _entity_key(entity)
+    return u'%s\t%s' % (entity.__class__.__name__, name)
+
+
+_MATCH_FIELDS = ('datetime', 'keyname', 'duration', 'title', 'artist')
+
+
+def _match_fields(node, complete=True):
+    """Returns a dict with the fields of a match element. Unless
+    `complete`, the fields it lacks are left out instead of set to None."""
+    fields = {'datetime': _extract(node, 'datetime'),
+              'keyname': _extract(node, 'keyname'),
+              'duration': _extract(node, 'duration'),
+              'title': _extract(node, 'name'),
+              'artist': _extract(node, 'name', 1)}
+    if not complete:
+        for name, value in fields.items():
+            if value is None:
+                del fields[name]
+    return fields
+
+
+def hydrate_matches(matches, max_workers=8):
+    """Loads the info of many matches concurrently, so their getters don't
+    send any request. Returns the list of matches."""
+    matches = list(matches)
+    missing = [match for match in matches if not match._is_complete()]
+    if missing:
+        pool = ThreadPool(min(max_workers, len(missing)))
+        try:
+            pool.map(Match._hydrate, missing)
+        finally:
+            pool.close()
+    return matches
 
 
 def _number(string):
@@ -618,6 +4644,25 @@ def _date(date):
     return date.strftime('%Y%m%d')
 
 
+def _cache_policy(cache, params):
+    """Returns the (cacheable, ttl) of a request.
+
+    `cache` is True to cache for ever, False not to cache, a number of
+    seconds, or None to decide from the `end` of the query: windows that
+    closed before today never change and are cached for ever, while the
+    ones that include today are cached for the recent TTL."""
+    if cache is None:
+        end = params.get('end')
+        if end is not None and end < _date(datetime.datetime.utcnow()):
+            return True, None
+        cache = _get_recent_ttl()
+    if cache is True or cache is False:
+        return cache, None
+    if not cache:
+        return False, None
+    return True, cache
+
+
 def _period(period):
     if period == DAY:
         return 'day'
@@ -628,17 +4673,22 @@ def _period(period):
     return 'week'
 
 
-def enable_caching(cache_dir=None):
-    global __cache_dir
+def enable_caching(cache_dir=None, backend=None):
+    """Caches the responses of cacheable requests.
+    #Parametres:
+      * cache_dir str: Directory of the default DiskCache, a temporary
+        one if None.
+      * backend CacheBackend: Cache to use instead of a DiskCache, like
+        a SQLiteCache.
+    """
     global __cache_enabled
+    global __cache_backend
 
-    if cache_dir is None:
-        import tempfile
-        __cache_dir = tempfile.mkdtemp()
-    else:
-        if not os.path.exists(cache_dir):
-            os.mkdir(cache_dir)
-        __cache_dir = cache_dir
+    if backend is None:
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp()
+        backend = DiskCache(cache_dir)
+    __cache_backend = backend
     __cache_enabled = True
 
 
@@ -653,15 +4703,792 @@ def is_caching_enabled():
     return __cache_enabled
 
 
-def _get_cache_dir():
-    """Returns the directory in which cache files are saved."""
-    global __cache_dir
-    global __cache_enabled
-    return __cache_dir
+def _get_cache_backend():
+    """Returns the backend in which responses are cached."""
+    global __cache_backend
+    return __cache_backend
+
+
+def _makedirs(path):
+    """Creates a directory and its parents unless they exist."""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _file_size(path):
+    """Returns the size of a file, 0 if it doesn't exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    """Removes a file, ignoring it if it doesn't exist."""
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def enable_memory_cache(max_entries=10000, max_bytes=64 * 1024 * 1024,
+                        ttl=3600):
+    """Keeps parsed responses of cacheable requests in memory.
+
+    The memory cache sits in front of the disk cache from enable_caching,
+    so repeated lookups skip both the disk and the parsing.
+    #Parametres:
+      * max_entries int: Maximum number of responses kept.
+      * max_bytes int: Maximum size of the responses kept.
+      * ttl int: Seconds a response is kept, None for ever.
+    """
+    global __memory_cache
+
+    __memory_cache = _MemoryCache(max_entries, max_bytes, ttl)
+
+
+def disable_memory_cache():
+    global __memory_cache
+
+    __memory_cache = None
+
+
+def get_memory_cache_stats():
+    """Returns a dict with the counters of the memory cache or None if it
+    is disabled."""
+    cache = _get_memory_cache()
+    if cache is None:
+        return None
+    return cache.get_stats()
+
+
+def _get_memory_cache():
+    """Returns the memory cache or None if it is disabled."""
+    global __memory_cache
+    return __memory_cache
+
+
+def _get_session(username, api_key):
+    """Returns the session shared by the objects with these credentials."""
+    global __sessions
+
+    key = (username, api_key)
+    session = __sessions.get(key)
+    if session is None:
+        __sessions_lock.acquire()
+        try:
+            session = __sessions.setdefault(key, Session(username, api_key))
+        finally:
+            __sessions_lock.release()
+    return session
+
+
+def set_channel_catalog(catalog):
+    """Makes Channel getters read from a ChannelCatalog before sending
+    a channel/info request. None stops using it."""
+    global __channel_catalog
+
+    __channel_catalog = catalog
+
+
+def _get_channel_catalog():
+    global __channel_catalog
+    return __channel_catalog
+
+
+def set_series_store(store):
+    """Sets the SeriesStore keeping the counts of playcount series."""
+    global __series_store
+
+    __series_store = store
+
+
+def _get_series_store():
+    global __series_store
+    if __series_store is None:
+        __series_store = SeriesStore()
+    return __series_store
+
+
+def set_recent_ttl(ttl):
+    """Sets for how many seconds the queries whose time window includes
+    today are cached, 0 not to cache them. Queries over past windows are
+    cached for ever."""
+    global __recent_ttl
+
+    __recent_ttl = ttl
+
+
+def _get_recent_ttl():
+    global __recent_ttl
+    return __recent_ttl
+
+
+def configure_connection_pool(size=10, idle_timeout=60):
+    """Sets up the pool of persistent connections shared by every request.
+    #Parametres:
+      * size int: Maximum number of simultaneous connections.
+      * idle_timeout int: Seconds an idle connection is kept alive.
+    """
+    global __connection_pool
+
+    __connection_pool_lock.acquire()
+    try:
+        if __connection_pool is not None:
+            __connection_pool.clear()
+        __connection_pool = _ConnectionPool(size, idle_timeout)
+    finally:
+        __connection_pool_lock.release()
+
+
+def get_connection_pool_stats():
+    """Returns a dict with the counters of the connection pool."""
+    return _get_connection_pool().get_stats()
+
+
+def add_hook(hook):
+    """Calls `hook(event, method, seconds, info)` on every instrumentation
+    event of the requests of all the threads. Hooks must be fast.
+
+    The events are 'request' (a call answered, from the cache or not),
+    'error' (a call failed, info has the 'error' class name),
+    'cache_get' (info has 'hit' and 'level', 'memory' or 'backend'),
+    'cache_set', 'download' (info has the compressed 'bytes' and the
+    'status'), 'revalidate' (info tells if the response was 'modified'),
+    'parse' (including the listed objects, built as they're parsed) and
+    'build'.
+    """
+    global __hooks
+
+    __metrics_lock.acquire()
+    __hooks = __hooks + [hook]
+    __metrics_lock.release()
+
+
+def remove_hook(hook):
+    global __hooks
+
+    __metrics_lock.acquire()
+    __hooks = [other for other in __hooks if other is not hook]
+    __metrics_lock.release()
+
+
+def enable_metrics():
+    """Keeps counters and latency histograms per method. On by default."""
+    global __metrics_enabled
+
+    __metrics_enabled = True
+
+
+def disable_metrics():
+    global __metrics_enabled
+
+    __metrics_enabled = False
+
+
+def reset_metrics():
+    """Starts the counters and histograms from zero."""
+    global __metrics
+
+    __metrics = None
+
+
+def _get_metrics():
+    global __metrics
+    global __metrics_enabled
+
+    if not __metrics_enabled:
+        return None
+    if __metrics is None:
+        __metrics_lock.acquire()
+        try:
+            if __metrics is None:
+                __metrics = _Metrics()
+        finally:
+            __metrics_lock.release()
+    return __metrics
+
+
+def _emit(event, method, seconds, info=None):
+    """Sends an instrumentation event to the metrics and the hooks."""
+    global __hooks
+
+    metrics = _get_metrics()
+    if metrics is not None:
+        metrics.record(event, method, seconds, info)
+    for hook in __hooks:
+        hook(event, method, seconds, info)
+
+
+def get_metrics():
+    """Returns a dict with the counters and latency histograms of every
+    method, like 'artist/toptracks', keyed by method name."""
+    metrics = _get_metrics()
+    if metrics is None:
+        return {}
+    return metrics.snapshot()
+
+
+def get_metrics_text():
+    """Returns the metrics in the Prometheus text exposition format."""
+    lines = []
+    snapshot = get_metrics()
+    counters = sorted(set(name for metrics in snapshot.values()
+                          for name, value in metrics.items()
+                          if isinstance(value, (int, long))))
+    for name in counters:
+        metric = 'pycast_%s_total' % name
+        lines.append('# TYPE %s counter' % metric)
+        for method in sorted(snapshot):
+            lines.append('%s{method="%s"} %d' % (
+                metric, _label(method), snapshot[method][name]))
+    lines.append('# TYPE pycast_errors_by_type_total counter')
+    for method in sorted(snapshot):
+        for error, count in sorted(
+                snapshot[method]['errors_by_type'].items()):
+            lines.append(
+                'pycast_errors_by_type_total{method="%s",error="%s"} %d'
+                % (_label(method), _label(error), count))
+    events = sorted(set(event for metrics in snapshot.values()
+                        for event in metrics['seconds']))
+    for event in events:
+        metric = 'pycast_%s_seconds' % event
+        lines.append('# TYPE %s histogram' % metric)
+        for method in sorted(snapshot):
+            histogram = snapshot[method]['seconds'].get(event)
+            if histogram is None:
+                continue
+            method = _label(method)
+            for bound, count in histogram['buckets']:
+                lines.append('%s_bucket{method="%s",le="%s"} %d' % (
+                    metric, method, _bound(bound), count))
+            lines.append('%s_sum{method="%s"} %r' % (
+                metric, method, histogram['sum']))
+            lines.append('%s_count{method="%s"} %d' % (
+                metric, method, histogram['count']))
+    for name, value in sorted(get_request_stats().items()):
+        lines.append('# TYPE pycast_transport_%s_total counter' % name)
+        lines.append('pycast_transport_%s_total %d' % (name, value))
+    for name, value in sorted(get_connection_pool_stats().items()):
+        lines.append('# TYPE pycast_connection_pool_%s gauge' % name)
+        lines.append('pycast_connection_pool_%s %d' % (name, value))
+    credentials = get_credential_stats() or {}
+    names = sorted(set(name for stats in credentials.values()
+                       for name in stats))
+    for name in names:
+        if name in ('in_flight', 'suspended'):
+            metric = 'pycast_credential_%s' % name
+            lines.append('# TYPE %s gauge' % metric)
+        else:
+            metric = 'pycast_credential_%s_total' % name
+            lines.append('# TYPE %s counter' % metric)
+        for username in sorted(credentials):
+            lines.append('%s{user="%s"} %r' % (
+                metric, _label(username), credentials[username][name]))
+    return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    """Escapes a Prometheus label value."""
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(float(bound))
+
+
+def set_proxy(address):
+    """Sends the requests to a ProxyServer at a 'host:port' or a
+    'unix:/path' instead of the web service. None stops using it."""
+    global __proxy
+
+    __proxy = address
+
+
+def _get_proxy():
+    global __proxy
+    return __proxy
+
+
+def set_request_timeout(timeout):
+    """Makes every request fail with DeadlineExceeded if waiting for a
+    connection, sending it, reading and parsing its response take more
+    than `timeout` seconds in all. None waits for ever."""
+    global __request_timeout
+
+    __request_timeout = timeout
+
+
+@contextmanager
+def deadline(timeout):
+    """Makes the requests sent by this thread within a `with` block fail
+    with DeadlineExceeded once `timeout` seconds have passed:
+
+        with pycast.deadline(2.5):
+            tracks = bbc.get_top_tracks()
+    """
+    global __deadlines
+
+    previous = getattr(__deadlines, 'at', None)
+    at = time.time() + timeout
+    if previous is not None:
+        at = min(at, previous)
+    __deadlines.at = at
+    try:
+        yield
+    finally:
+        __deadlines.at = previous
+
+
+def _get_deadline():
+    """Returns the time by which a request starting now must complete, or
+    None if it has no deadline."""
+    global __deadlines
+    global __request_timeout
+
+    at = getattr(__deadlines, 'at', None)
+    if __request_timeout is not None:
+        timeout_at = time.time() + __request_timeout
+        if at is None or timeout_at < at:
+            at = timeout_at
+    return at
+
+
+def _remaining(at):
+    """Returns the seconds left until `at`, raising DeadlineExceeded if
+    there are none."""
+    if at is None:
+        return None
+    remaining = at - time.time()
+    if remaining <= 0:
+        _count_request('timeouts')
+        raise DeadlineExceeded(None, 'Deadline exceeded')
+    return remaining
+
+
+def enable_hedging(percentile=95, min_samples=20, window=1000):
+    """Sends a backup of the requests that take longer than usual and
+    uses whichever response arrives first.
+    #Parametres:
+      * percentile float: Percentile of the recent latencies of a method
+        after which a backup request is sent.
+      * min_samples int: Latencies known before hedging a method.
+      * window int: Number of recent latencies kept per method.
+    """
+    global __hedger
+
+    __hedger = _Hedger(percentile, min_samples, window)
+
+
+def disable_hedging():
+    global __hedger
+
+    __hedger = None
+
+
+def _get_hedger():
+    global __hedger
+    return __hedger
+
+
+def _count_request(name):
+    global __request_stats
+
+    __request_stats_lock.acquire()
+    __request_stats[name] += 1
+    __request_stats_lock.release()
+
+
+def get_request_stats():
+    """Returns a dict with the number of requests that timed out and,
+    when hedging is enabled, how many were hedged and how many of those
+    the backup request won."""
+    global __request_stats
+
+    __request_stats_lock.acquire()
+    try:
+        stats = dict(__request_stats)
+    finally:
+        __request_stats_lock.release()
+    hedger = _get_hedger()
+    if hedger is not None:
+        stats.update(hedger.get_stats())
+    return stats
+
+
+def configure_transport_policy(rate=None, burst=None, retries=3,
+                               backoff=0.5, max_backoff=30,
+                               retry_statuses=(429, 500, 502, 503, 504),
+                               retry_codes=(), breaker_threshold=5,
+                               breaker_timeout=30, max_concurrency=None):
+    """Sets how requests behave when the service throttles or fails.
+    #Parametres:
+      * rate float: Maximum requests per second, unlimited if None.
+      * burst int: Requests that may be sent at once under the rate.
+      * retries int: Times a request is retried after a transient error.
+      * backoff float: Seconds of the first retry delay, which doubles on
+        every retry and is randomized.
+      * max_backoff float: Maximum seconds between retries.
+      * retry_statuses tuple: HTTP statuses to retry. Connection errors
+        are always transient.
+      * retry_codes tuple: Service error codes to retry.
+      * breaker_threshold int: Consecutive transient errors that make
+        requests fail fast with CircuitOpenError, 0 not to.
+      * breaker_timeout float: Seconds to fail fast before trying again.
+      * max_concurrency int: Maximum requests running at once. The limit
+        halves when the server throttles and grows back slowly.
+    """
+    global __transport_policy
+
+    __transport_policy = _TransportPolicy(
+        rate, burst, retries, backoff, max_backoff, retry_statuses,
+        retry_codes, breaker_threshold=breaker_threshold,
+        breaker_timeout=breaker_timeout, max_concurrency=max_concurrency)
+
+
+def disable_transport_policy():
+    """Sends requests once, without rate limits."""
+    global __transport_policy
+
+    __transport_policy = None
+
+
+def get_transport_policy_stats():
+    """Returns a dict with the counters of the transport policy, or None
+    if there is no policy."""
+    policy = _get_transport_policy()
+    if policy is None:
+        return None
+    return policy.get_stats()
+
+
+def _get_transport_policy():
+    global __transport_policy
+    return __transport_policy
+
+
+def configure_credential_pool(credentials, rate=None, burst=None,
+                              max_in_flight=None, suspend=60,
+                              suspend_statuses=(401, 403, 429),
+                              suspend_codes=()):
+    """Sends the requests with several api keys instead of the ones of
+    each object, to add up their quotas. Cached responses are shared by
+    all the keys.
+    #Parametres:
+      * credentials list: (username, api_key) pairs.
+      * rate float: Maximum requests per second of each key.
+      * burst int: Requests that may be sent at once under the rate.
+      * max_in_flight int: Maximum requests running at once with a key.
+      * suspend float: Seconds a key is left aside when it is refused.
+      * suspend_statuses tuple: HTTP statuses refusing a key.
+      * suspend_codes tuple: Service error codes refusing a key, like
+        those of exhausted quotas or invalid keys.
+    """
+    global __credential_pool
+
+    __credential_pool = _CredentialPool(
+        credentials, rate, burst, max_in_flight, suspend, suspend_statuses,
+        suspend_codes)
+
+
+def disable_credential_pool():
+    """Sends the requests with the api key of each object again."""
+    global __credential_pool
+
+    __credential_pool = None
+
+
+def get_credential_stats():
+    """Returns a dict with the requests, errors, suspensions, rate waits,
+    requests in flight and seconds left suspended of each key of the
+    pool by username, or None if there is no pool."""
+    pool = _get_credential_pool()
+    if pool is None:
+        return None
+    return pool.get_stats()
+
+
+def _get_credential_pool():
+    global __credential_pool
+    return __credential_pool
+
+
+def _get_connection_pool():
+    """Returns the shared connection pool, creating it if needed."""
+    global __connection_pool
+
+    pool = __connection_pool
+    if pool is None or pool.pid != os.getpid():
+        __connection_pool_lock.acquire()
+        try:
+            pool = __connection_pool
+            if pool is None:
+                __connection_pool = _ConnectionPool()
+            elif pool.pid != os.getpid():
+                # A forked process must not share the sockets of its parent.
+                __connection_pool = _ConnectionPool(
+                    pool.size, pool.idle_timeout)
+        finally:
+            __connection_pool_lock.release()
+    return __connection_pool
+
+
+def _check_status(host, path, status, reason, headers, body):
+    """Raises a HTTPError unless the response status is 200."""
+    if status != 200:
+        raise urllib2.HTTPError(
+            'http://' + host + path, status, reason, headers, StringIO(body))
+
+
+def _set_timeout(connection, timeout):
+    """Sets the timeout of a HTTPConnection and of its open socket."""
+    if timeout is None:
+        timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+    connection.timeout = timeout
+    if connection.sock is not None:
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            connection.sock.settimeout(socket.getdefaulttimeout())
+        else:
+            connection.sock.settimeout(timeout)
+
+
+def _split_server(server):
+    """Splits a WS_SERVER like string in its host and base path."""
+    host, _, base = server.partition('/')
+    return host, '/' + base
 
 
 def get_md5(text):
-    """Returns the md5 hash of a string."""
+    """Returns the md5 hash of a string. Unicode is hashed as UTF-8 and
+    byte strings as they are:
+
+        >>> get_md5('Bj\\xc3\\xb6rk') == get_md5(u'Bj\\xf6rk')
+        True
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
     hash = md5()
-    hash.update(text.encode('utf8'))
+    hash.update(text)
     return hash.hexdigest()
+
+
+EXPORT_FIELDS = ('source', 'match', 'datetime', 'channel', 'artist', 'title',
+                 'duration')
+
+
+def export_matches(entities, start, end, output, format='csv', compress=None,
+                   max_workers=4, limit=50, prefetch=2):
+    """Streams the matches of many entities over a date range to a file.
+    #Parametres:
+      * entities list: Channel, Artist or Label objects.
+      * start date: First day of the range.
+      * end date: Last day of the range.
+      * output str: Path of the file to write, '-' for the standard output.
+      * format str: 'csv' or 'jsonl' (JSON Lines).
+      * compress bool: Gzip the output, by default if the path ends in .gz.
+      * max_workers int: Number of entities exported at once.
+      * limit int: Matches per page.
+      * prefetch int: Pages fetched ahead for each entity.
+    Matches are written page by page, so memory use doesn't depend on the
+    length of the range. Returns the number of matches written.
+    """
+    if compress is None:
+        compress = output.endswith('.gz')
+    writer = _MatchWriter(output, format, compress)
+    try:
+        jobs = [(entity, start, end, limit, prefetch, writer)
+                for entity in entities]
+        if not jobs:
+            return 0
+        pool = ThreadPool(min(max_workers, len(jobs)))
+        try:
+            counts = pool.map(_export_entity, jobs, 1)
+        finally:
+            pool.close()
+    finally:
+        writer.close()
+    return sum(counts)
+
+
+def _export_entity(job):
+    """Writes the matches of an entity, returning how many there were."""
+    entity, start, end, limit, prefetch, writer = job
+    source = _entity_key(entity)
+    count = 0
+    matches = _iter_range_matches(entity, start, end, limit, prefetch)
+    for page in _chunks(matches, limit):
+        hydrate_matches(page)
+        writer.write([_match_row(source, match) for match in page])
+        count += len(page)
+    return count
+
+
+def _match_row(source, match):
+    track = match.get_track()
+    return (source, match.get_id(), match.get_datetime().isoformat(),
+            match.get_channel().get_keyname(), track.get_artist().get_name(),
+            track.get_title(), match.get_duration())
+
+
+def _iter_range_matches(entity, start, end, limit, prefetch):
+    """Yields the matches of an entity from start to end, day after day.
+
+    The pages of every day go through a single prefetching pipeline, so
+    the next days are fetched while the current one is consumed."""
+    return _iter_keyed_pages(
+        lambda day, page: entity.get_matches(DAY, day, page, limit),
+        _days(start, end), limit, prefetch)
+
+
+def _days(start, end):
+    """Yields every date from start to end, both included."""
+    day = start
+    while day <= end:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def _chunks(iterable, size):
+    """Yields lists of `size` items of an iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _MatchWriter(object):
+    """Writes export rows to a CSV or JSON Lines file from many threads."""
+
+    def __init__(self, output, format, compress):
+        if format not in ('csv', 'jsonl'):
+            raise ValueError('Unknown export format: %s' % format)
+        self.format = format
+        self._lock = threading.Lock()
+        if output == '-':
+            self._file = sys.stdout
+            self._close = False
+            if compress:
+                self._file = gzip.GzipFile(fileobj=sys.stdout, mode='wb')
+                self._close = True
+        elif compress:
+            self._file = gzip.open(output, 'wb')
+            self._close = True
+        else:
+            self._file = open(output, 'wb')
+            self._close = True
+        if format == 'csv':
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(EXPORT_FIELDS)
+
+    def write(self, rows):
+        self._lock.acquire()
+        try:
+            if self.format == 'csv':
+                self._csv.writerows([map(_utf8, row) for row in rows])
+            else:
+                for row in rows:
+                    self._file.write(
+                        json.dumps(OrderedDict(zip(EXPORT_FIELDS, row))))
+                    self._file.write('\n')
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self._close:
+            self._file.close()
+        else:
+            self._file.flush()
+
+
+def main(argv=None):
+    """Runs the pycast command line tool."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pycast', description=__doc__)
+    parser.add_argument('--user', default=os.environ.get('PYCAST_USER'),
+                        help='Vericast user, $PYCAST_USER by default')
+    parser.add_argument('--key', default=os.environ.get('PYCAST_KEY'),
+                        help='Vericast api key, $PYCAST_KEY by default')
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser(
+        'export', help='Export the matches of a date range')
+    export.add_argument('--channel', action='append', default=[],
+                        help='Channel keyname, may be repeated')
+    export.add_argument('--artist', action='append', default=[],
+                        help='Artist name, may be repeated')
+    export.add_argument('--label', action='append', default=[],
+                        help='Label name, may be repeated')
+    export.add_argument('--from', dest='start', required=True,
+                        type=_parse_day, help='First day, as YYYY-MM-DD')
+    export.add_argument('--to', dest='end', required=True, type=_parse_day,
+                        help='Last day, as YYYY-MM-DD')
+    export.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    export.add_argument('--gzip', action='store_true', default=None,
+                        help='Compress the output')
+    export.add_argument('--output', default='-',
+                        help='File to write, the standard output by default')
+    export.add_argument('--workers', type=int, default=4,
+                        help='Entities exported at once')
+    daemon = commands.add_parser(
+        'daemon', help='Run a local caching proxy of the web service')
+    daemon.add_argument('--listen', default='127.0.0.1:8437',
+                        help='host:port or unix:/path to listen on')
+    daemon.add_argument('--cache-dir', help='Directory of a disk cache')
+    daemon.add_argument('--sqlite', help='File of a SQLite cache')
+    daemon.add_argument('--pool-size', type=int, default=10,
+                        help='Connections to the web service')
+    daemon.add_argument('--server', default=WS_SERVER,
+                        help='Host and path of the web service')
+    args = parser.parse_args(argv)
+    if args.command == 'daemon':
+        return _run_daemon(args)
+    if not args.user or not args.key:
+        parser.error('the Vericast user and api key are needed')
+    session = Session(args.user, args.key)
+    entities = ([session.channel(keyname) for keyname in args.channel] +
+                [session.artist(name) for name in args.artist] +
+                [session.label(name) for name in args.label])
+    if not entities:
+        parser.error('at least a channel, artist or label is needed')
+    count = export_matches(entities, args.start, args.end, args.output,
+                           args.format, args.gzip, args.workers)
+    sys.stderr.write('%d matches exported\n' % count)
+    return 0
+
+
+def _run_daemon(args):
+    """Runs a ProxyServer until interrupted or terminated."""
+    import signal
+    global WS_SERVER
+
+    WS_SERVER = args.server
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.sqlite:
+        enable_caching(backend=SQLiteCache(args.sqlite))
+    else:
+        enable_caching(args.cache_dir)
+    configure_connection_pool(args.pool_size)
+    proxy = ProxyServer(args.listen)
+    sys.stderr.write('Proxying %s on %s\n' % (WS_SERVER, proxy.address))
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+    return 0
+
+
+def _parse_day(text):
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
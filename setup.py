@@ -10,4 +10,5 @@ setup(
     author_email = "vericast-support@bmat.com",
     url = "http://bmat.com/products/vericast/index.php",
     py_modules = ("pycast",),
+    scripts = ("scripts/pycast",),
     license = "gpl")